@@ -7,15 +7,20 @@ Sentiment classification with GPT-2 on SST and CFIMDB.
 import random, numpy as np, argparse
 from types import SimpleNamespace
 import csv
+import os
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 from transformers import GPT2Tokenizer
 from sklearn.metrics import f1_score, accuracy_score
 
+from datasets import TokenCache, collate_token_ids, content_hash
 from models.gpt2 import GPT2Model
 from optimizer import AdamW
+from samplers import length_grouped_dataloader
+from utils import (FEATURE_CACHE, add_efficiency_arguments, autocast_context, batch_cu_seqlens, gpt_config_kwargs,
+                   load_task_checkpoint, parse_gradient_checkpointing, state_dict_hash)
 from tqdm import tqdm
 
 TQDM_DISABLE = False
@@ -35,10 +40,14 @@ def seed_everything(seed=11711):
 class GPT2SentimentClassifier(torch.nn.Module):
   '''GPT-2 + linear head for sentiment classification (SST has 5 classes, CFIMDB is binary).'''
 
-  def __init__(self, config):
+  def __init__(self, config, pretrained=True):
     super(GPT2SentimentClassifier, self).__init__()
     self.num_labels = config.num_labels
-    self.gpt = GPT2Model.from_pretrained()
+    if pretrained:
+      self.gpt = GPT2Model.from_pretrained(**gpt_config_kwargs(config))
+    else:
+      # Architecture only, for when every weight comes from our own checkpoint.
+      self.gpt = GPT2Model.from_size(**gpt_config_kwargs(config))
 
     assert config.fine_tune_mode in ["last-linear-layer", "full-model"]
     for param in self.gpt.parameters():
@@ -51,47 +60,56 @@ class GPT2SentimentClassifier(torch.nn.Module):
     self.classifier = torch.nn.Linear(config.hidden_size, self.num_labels)
 
 
-  def forward(self, input_ids, attention_mask):
+  def forward(self, input_ids, attention_mask, cu_seqlens=None):
     '''last token embedding -> dropout -> classify'''
-    gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask)
-    last_token = gpt_outputs['last_token']
+    gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask, cu_seqlens=cu_seqlens,
+                           return_last_token_only=True)
+    return self.classify(gpt_outputs['last_token'])
+
+  def classify(self, last_token):
+    '''The head alone, on last token embeddings [batch_size, hidden_size].'''
     last_token = self.dropout(last_token)
     logits = self.classifier(last_token)
     return logits
 
+  @classmethod
+  def from_checkpoint(cls, saved):
+    '''The model saved by save_model (or quantization.py), without downloading or converting GPT-2 weights.'''
+    return load_task_checkpoint(cls, saved)
+
 
 
 class SentimentDataset(Dataset):
   def __init__(self, dataset, args):
     self.dataset = dataset
     self.p = args
+    self.packed = getattr(args, 'packed', False)
     self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
     self.tokenizer.pad_token = self.tokenizer.eos_token
+    self.token_cache = TokenCache([x[0] for x in dataset], self.tokenizer)
 
   def __len__(self):
     return len(self.dataset)
 
   def __getitem__(self, idx):
-    return self.dataset[idx]
+    return (*self.dataset[idx], self.token_cache[idx])
 
   def pad_data(self, data):
     sents = [x[0] for x in data]
     labels = [x[1] for x in data]
     sent_ids = [x[2] for x in data]
+    token_ids = [x[3] for x in data]
 
-    encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-    token_ids = torch.LongTensor(encoding['input_ids'])
-    attention_mask = torch.LongTensor(encoding['attention_mask'])
+    inputs = collate_token_ids(token_ids, self.tokenizer.pad_token_id, packed=self.packed)
     labels = torch.LongTensor(labels)
 
-    return token_ids, attention_mask, labels, sents, sent_ids
+    return inputs, labels, sents, sent_ids
 
   def collate_fn(self, all_data):
-    token_ids, attention_mask, labels, sents, sent_ids = self.pad_data(all_data)
+    inputs, labels, sents, sent_ids = self.pad_data(all_data)
 
     batched_data = {
-      'token_ids': token_ids,
-      'attention_mask': attention_mask,
+      **inputs,
       'labels': labels,
       'sents': sents,
       'sent_ids': sent_ids
@@ -104,31 +122,31 @@ class SentimentTestDataset(Dataset):
   def __init__(self, dataset, args):
     self.dataset = dataset
     self.p = args
+    self.packed = getattr(args, 'packed', False)
     self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
     self.tokenizer.pad_token = self.tokenizer.eos_token
+    self.token_cache = TokenCache([x[0] for x in dataset], self.tokenizer)
 
   def __len__(self):
     return len(self.dataset)
 
   def __getitem__(self, idx):
-    return self.dataset[idx]
+    return (*self.dataset[idx], self.token_cache[idx])
 
   def pad_data(self, data):
     sents = [x[0] for x in data]
     sent_ids = [x[1] for x in data]
+    token_ids = [x[2] for x in data]
 
-    encoding = self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-    token_ids = torch.LongTensor(encoding['input_ids'])
-    attention_mask = torch.LongTensor(encoding['attention_mask'])
+    inputs = collate_token_ids(token_ids, self.tokenizer.pad_token_id, packed=self.packed)
 
-    return token_ids, attention_mask, sents, sent_ids
+    return inputs, sents, sent_ids
 
   def collate_fn(self, all_data):
-    token_ids, attention_mask, sents, sent_ids = self.pad_data(all_data)
+    inputs, sents, sent_ids = self.pad_data(all_data)
 
     batched_data = {
-      'token_ids': token_ids,
-      'attention_mask': attention_mask,
+      **inputs,
       'sents': sents,
       'sent_ids': sent_ids
     }
@@ -164,7 +182,7 @@ def load_data(filename, flag='train'):
 
 
 # Evaluate the model on dev examples.
-def model_eval(dataloader, model, device):
+def model_eval(dataloader, model, device, precision='fp32'):
   model.eval()  # Switch to eval model, will turn off randomness like dropout.
   y_true = []
   y_pred = []
@@ -176,9 +194,11 @@ def model_eval(dataloader, model, device):
 
     b_ids = b_ids.to(device)
     b_mask = b_mask.to(device)
+    b_cu_seqlens = batch_cu_seqlens(batch, device)
 
-    logits = model(b_ids, b_mask)
-    logits = logits.detach().cpu().numpy()
+    with autocast_context(device, precision):
+      logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
+    logits = logits.detach().float().cpu().numpy()
     preds = np.argmax(logits, axis=1).flatten()
 
     b_labels = b_labels.flatten()
@@ -194,7 +214,7 @@ def model_eval(dataloader, model, device):
 
 
 # Evaluate the model on test examples.
-def model_test_eval(dataloader, model, device):
+def model_test_eval(dataloader, model, device, precision='fp32'):
   model.eval()  # Switch to eval model, will turn off randomness like dropout.
   y_pred = []
   sents = []
@@ -205,9 +225,11 @@ def model_test_eval(dataloader, model, device):
 
     b_ids = b_ids.to(device)
     b_mask = b_mask.to(device)
+    b_cu_seqlens = batch_cu_seqlens(batch, device)
 
-    logits = model(b_ids, b_mask)
-    logits = logits.detach().cpu().numpy()
+    with autocast_context(device, precision):
+      logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
+    logits = logits.detach().float().cpu().numpy()
     preds = np.argmax(logits, axis=1).flatten()
 
     y_pred.extend(preds)
@@ -217,6 +239,80 @@ def model_test_eval(dataloader, model, device):
   return y_pred, sents, sent_ids
 
 
+@torch.no_grad()
+def cached_features(model, dataset, args, device, cache_dir=FEATURE_CACHE):
+  '''
+  The frozen GPT-2's last token embedding of every example in dataset and the labels, as tensors on device.
+  The embeddings are computed once into an np.memmap [num_examples, hidden_size] in cache_dir, keyed by the
+  backbone weights, the tokenized data and the precision, so later epochs and runs never run GPT-2 again.
+  '''
+  key = content_hash(state_dict_hash(model.gpt), dataset.token_cache.path, args.precision, args.attention_backend)
+  path = os.path.join(cache_dir, f'{key}.npy')
+  if not os.path.exists(path):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                         shape=(len(dataset), model.classifier.in_features))
+    model.eval()
+    batch_sampler = length_grouped_dataloader(dataset, args, shuffle=False).batch_sampler
+    for indices in tqdm(batch_sampler, desc='features', disable=TQDM_DISABLE):
+      batch = dataset.collate_fn([dataset[i] for i in indices])
+      with autocast_context(device, args.precision):
+        last_token = model.gpt(batch['token_ids'].to(device), batch['attention_mask'].to(device),
+                               cu_seqlens=batch_cu_seqlens(batch, device), return_last_token_only=True)['last_token']
+      features[indices] = last_token.float().cpu().numpy()
+    features.flush()
+    del features
+    os.replace(tmp_path, path)
+
+  features = torch.tensor(np.load(path, mmap_mode='r'), dtype=model.classifier.weight.dtype, device=device)
+  labels = torch.tensor([x[1] for x in dataset.dataset], device=device)
+  return features, labels
+
+
+@torch.no_grad()
+def head_accuracy(model, features, labels):
+  model.eval()
+  preds = model.classify(features).argmax(dim=-1)
+  return (preds == labels).float().mean().item()
+
+
+def train_head(model, optimizer, train_dataloader, dev_dataloader, args, config, device):
+  '''The epochs of train() for a frozen GPT-2 (last-linear-layer): only the head runs, on cached features.'''
+  train_features, train_labels = cached_features(model, train_dataloader.dataset, args, device)
+  dev_features, dev_labels = cached_features(model, dev_dataloader.dataset, args, device)
+  best_dev_acc = 0
+
+  for epoch in range(args.epochs):
+    model.train()
+    train_loss = 0
+    num_batches = 0
+    for indices in tqdm(train_dataloader.batch_sampler, desc=f'train-{epoch}', disable=TQDM_DISABLE):
+      indices = torch.tensor(indices, device=device)
+
+      optimizer.zero_grad()
+      with autocast_context(device, args.precision):
+        logits = model.classify(train_features[indices])
+      loss = F.cross_entropy(logits.float(), train_labels[indices], reduction='mean')
+
+      loss.backward()
+      optimizer.step()
+
+      train_loss += loss.item()
+      num_batches += 1
+
+    train_loss = train_loss / (num_batches)
+
+    train_acc = head_accuracy(model, train_features, train_labels)
+    dev_acc = head_accuracy(model, dev_features, dev_labels)
+
+    if dev_acc > best_dev_acc:
+      best_dev_acc = dev_acc
+      save_model(model, optimizer, args, config, args.filepath)
+
+    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}")
+
+
 def save_model(model, optimizer, args, config, filepath):
   save_info = {
     'model': model.state_dict(),
@@ -241,25 +337,32 @@ def train(args):
   train_dataset = SentimentDataset(train_data, args)
   dev_dataset = SentimentDataset(dev_data, args)
 
-  train_dataloader = DataLoader(train_dataset, shuffle=True, batch_size=args.batch_size,
-                                collate_fn=train_dataset.collate_fn)
-  dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size,
-                              collate_fn=dev_dataset.collate_fn)
+  train_dataloader = length_grouped_dataloader(train_dataset, args, shuffle=True)
+  dev_dataloader = length_grouped_dataloader(dev_dataset, args, shuffle=False)
 
   # Init model.
   config = {'hidden_dropout_prob': args.hidden_dropout_prob,
             'num_labels': num_labels,
             'hidden_size': 768,
             'data_dir': '.',
-            'fine_tune_mode': args.fine_tune_mode}
+            'fine_tune_mode': args.fine_tune_mode,
+            'attention_backend': args.attention_backend,
+            'gradient_checkpointing': args.gradient_checkpointing,
+            'fused_qkv': args.fused_qkv}
 
   config = SimpleNamespace(**config)
 
   model = GPT2SentimentClassifier(config)
   model = model.to(device)
+  if args.bf16_weights:
+    model = model.to(torch.bfloat16)
 
   lr = args.lr
-  optimizer = AdamW(model.parameters(), lr=lr)
+  optimizer = AdamW(model.parameters(), lr=lr, master_weights=args.bf16_weights, foreach=True,
+                    flat=args.flat_optimizer, state_format=args.optimizer_state)
+  if args.fine_tune_mode == 'last-linear-layer':
+    train_head(model, optimizer, train_dataloader, dev_dataloader, args, config, device)
+    return
   best_dev_acc = 0
 
   # Run for the specified number of epochs.
@@ -274,10 +377,13 @@ def train(args):
       b_ids = b_ids.to(device)
       b_mask = b_mask.to(device)
       b_labels = b_labels.to(device)
+      b_cu_seqlens = batch_cu_seqlens(batch, device)
 
       optimizer.zero_grad()
-      logits = model(b_ids, b_mask)
-      loss = F.cross_entropy(logits, b_labels.view(-1), reduction='sum') / args.batch_size
+      with autocast_context(device, args.precision):
+        logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
+      # Per example: with --max_tokens the number of examples varies from batch to batch.
+      loss = F.cross_entropy(logits.float(), b_labels.view(-1), reduction='mean')
 
       loss.backward()
       optimizer.step()
@@ -286,41 +392,44 @@ def train(args):
       num_batches += 1
 
     train_loss = train_loss / (num_batches)
+    # Packed batches hold no padding; the sampler's ratio is for the padded layout.
+    padding_ratio = 0. if args.packed else train_dataloader.batch_sampler.padding_ratio
 
-    train_acc, train_f1, *_ = model_eval(train_dataloader, model, device)
-    dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device)
+    train_acc, train_f1, *_ = model_eval(train_dataloader, model, device, args.precision)
+    dev_acc, dev_f1, *_ = model_eval(dev_dataloader, model, device, args.precision)
 
     if dev_acc > best_dev_acc:
       best_dev_acc = dev_acc
       save_model(model, optimizer, args, config, args.filepath)
 
-    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}")
+    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, train acc :: {train_acc :.3f}, dev acc :: {dev_acc :.3f}, "
+          f"padding :: {padding_ratio :.1%}")
 
 
 def test(args):
   with torch.no_grad():
     device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-    saved = torch.load(args.filepath)
-    config = saved['model_config']
-    model = GPT2SentimentClassifier(config)
-    model.load_state_dict(saved['model'])
+    saved = torch.load(args.filepath, map_location='cpu', mmap=True, weights_only=False)
+    model = GPT2SentimentClassifier.from_checkpoint(saved)
+    if 'quantization' in saved:
+      # The int8 modules of a quantization.py artifact only run on CPU.
+      device = torch.device('cpu')
     model = model.to(device)
     print(f"load model from {args.filepath}")
 
     dev_data = load_data(args.dev, 'valid')
     dev_dataset = SentimentDataset(dev_data, args)
-    dev_dataloader = DataLoader(dev_dataset, shuffle=False, batch_size=args.batch_size,
-                                collate_fn=dev_dataset.collate_fn)
+    dev_dataloader = length_grouped_dataloader(dev_dataset, args, shuffle=False)
 
     test_data = load_data(args.test, 'test')
     test_dataset = SentimentTestDataset(test_data, args)
-    test_dataloader = DataLoader(test_dataset, shuffle=False, batch_size=args.batch_size,
-                                 collate_fn=test_dataset.collate_fn)
+    test_dataloader = length_grouped_dataloader(test_dataset, args, shuffle=False)
 
-    dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device)
+    dev_acc, dev_f1, dev_pred, dev_true, dev_sents, dev_sent_ids = model_eval(dev_dataloader, model, device,
+                                                                              args.precision)
     print('DONE DEV')
 
-    test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device)
+    test_pred, test_sents, test_sent_ids = model_test_eval(test_dataloader, model, device, args.precision)
     print('DONE Test')
 
     with open(args.dev_out, "w+") as f:
@@ -348,6 +457,14 @@ def get_args():
   parser.add_argument("--hidden_dropout_prob", type=float, default=0.3)
   parser.add_argument("--lr", type=float, help="learning rate, default lr for 'pretrain': 1e-3, 'finetune': 1e-5",
                       default=1e-3)
+  parser.add_argument("--attention_backend", type=str, help="attention implementation; chunked keeps long CFIMDB reviews in memory",
+                      choices=('reference', 'sdpa', 'chunked'), default='reference')
+  parser.add_argument("--gradient_checkpointing", type=parse_gradient_checkpointing, default='none',
+                      help="recompute layer activations in backward to save memory: none, all, every-<k> or budget-<MB>")
+  parser.add_argument("--packed", action='store_true',
+                      help="padding-free batches: concatenate each batch into one token stream instead of padding it")
+
+  add_efficiency_arguments(parser)
 
   args = parser.parse_args()
   return args
@@ -369,6 +486,15 @@ if __name__ == "__main__":
     dev='data/ids-sst-dev.csv',
     test='data/ids-sst-test-student.csv',
     fine_tune_mode=args.fine_tune_mode,
+    attention_backend=args.attention_backend,
+    gradient_checkpointing=args.gradient_checkpointing,
+    fused_qkv=args.fused_qkv,
+    packed=args.packed,
+    max_tokens=args.max_tokens,
+    precision=args.precision,
+    bf16_weights=args.bf16_weights,
+    flat_optimizer=args.flat_optimizer,
+    optimizer_state=args.optimizer_state,
     dev_out='predictions/' + args.fine_tune_mode + '-sst-dev-out.csv',
     test_out='predictions/' + args.fine_tune_mode + '-sst-test-out.csv'
   )
@@ -390,6 +516,15 @@ if __name__ == "__main__":
     dev='data/ids-cfimdb-dev.csv',
     test='data/ids-cfimdb-test-student.csv',
     fine_tune_mode=args.fine_tune_mode,
+    attention_backend=args.attention_backend,
+    gradient_checkpointing=args.gradient_checkpointing,
+    fused_qkv=args.fused_qkv,
+    packed=args.packed,
+    max_tokens=args.max_tokens,
+    precision=args.precision,
+    bf16_weights=args.bf16_weights,
+    flat_optimizer=args.flat_optimizer,
+    optimizer_state=args.optimizer_state,
     dev_out='predictions/' + args.fine_tune_mode + '-cfimdb-dev-out.csv',
     test_out='predictions/' + args.fine_tune_mode + '-cfimdb-test-out.csv'
   )
@@ -0,0 +1,77 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import torch
+
+from classifier import GPT2SentimentClassifier, SentimentDataset, cached_features
+from config import GPT2Config
+from models.gpt2 import GPT2Model
+
+SEED = 0
+CONFIG = SimpleNamespace(num_labels=2, hidden_dropout_prob=0.1, fine_tune_mode='last-linear-layer')
+DATA = [
+  ('a gripping , funny and touching film .', 1, 'a'),
+  ('dull .', 0, 'b'),
+  ('the plot goes nowhere , slowly , and the jokes land even less often than the punches .', 0, 'c'),
+  ('one of the year \'s best .', 1, 'd'),
+  ('it looks good , at least .', 0, 'e'),
+]
+
+
+class TinySentimentClassifier(GPT2SentimentClassifier):
+  """GPT2SentimentClassifier with a randomly initialised GPT-2 only 32 wide, but over GPT-2's real vocabulary."""
+
+  def __init__(self, config, pretrained=False):
+    torch.nn.Module.__init__(self)
+    self.num_labels = config.num_labels
+    self.gpt = GPT2Model(GPT2Config(hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                                    intermediate_size=128, max_position_embeddings=64))
+    for param in self.gpt.parameters():
+      param.requires_grad = False
+    self.dropout = torch.nn.Dropout(config.hidden_dropout_prob)
+    self.classifier = torch.nn.Linear(32, self.num_labels)
+
+
+def tiny_classifier():
+  torch.manual_seed(SEED)
+  return TinySentimentClassifier(CONFIG).eval()
+
+
+def test_cached_features():
+  model = tiny_classifier()
+  dataset = SentimentDataset(DATA, SimpleNamespace(packed=False))
+  args = SimpleNamespace(batch_size=2, precision='fp32', attention_backend='reference')
+  device = torch.device('cpu')
+  forwards = []
+  model.gpt.register_forward_hook(lambda module, inputs, outputs: forwards.append(1))
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+    features, labels = cached_features(model, dataset, args, device, cache_dir=cache_dir)
+    assert labels.tolist() == [label for _, label, _ in DATA]
+    # Each row is the example's last token embedding, whatever batch it was computed in.
+    with torch.no_grad():
+      for i in range(len(dataset)):
+        token_ids = torch.from_numpy(dataset.token_cache[i].astype('int64'))[None]
+        expected = model.gpt(token_ids, torch.ones_like(token_ids))['last_token'][0]
+        assert torch.allclose(features[i], expected, atol=1e-5)
+
+    # A second call reads the cache without running GPT-2.
+    forwards.clear()
+    cached, _ = cached_features(model, dataset, args, device, cache_dir=cache_dir)
+    assert not forwards
+    assert torch.equal(features, cached)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Different weights have a different state_dict_hash, so they miss the cache.
+    with torch.no_grad():
+      model.gpt.final_layer_norm.bias.add_(1.)
+    changed, _ = cached_features(model, dataset, args, device, cache_dir=cache_dir)
+    assert forwards
+    assert not torch.allclose(features, changed)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+if __name__ == '__main__':
+  test_cached_features()
+  print("Classifier tests passed!")
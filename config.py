@@ -204,8 +204,13 @@ class GPT2Config(PretrainedConfig):
           layer_norm_eps=1e-5,
           pad_token_id=0,
           gradient_checkpointing=False,
+          checkpoint_every=1,
+          checkpoint_budget_mb=None,
           position_embedding_type="learnable",
           use_cache=True,
+          fused_qkv=False,
+          attention_backend="reference",
+          attention_chunk_size=128,
           **kwargs
   ):
     super().__init__(pad_token_id=pad_token_id, **kwargs)
@@ -223,8 +228,13 @@ class GPT2Config(PretrainedConfig):
     self.initializer_range = initializer_range
     self.layer_norm_eps = layer_norm_eps
     self.gradient_checkpointing = gradient_checkpointing
+    self.checkpoint_every = checkpoint_every
+    self.checkpoint_budget_mb = checkpoint_budget_mb
     self.position_embedding_type = position_embedding_type
     self.use_cache = use_cache
+    self.fused_qkv = fused_qkv
+    self.attention_backend = attention_backend
+    self.attention_chunk_size = attention_chunk_size
 
 
 
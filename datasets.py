@@ -7,13 +7,24 @@ additional sources of data, or if you change how the Quora dataset is processed
 """
 
 import csv
+import inspect
+import json
+import os
+import shutil
+import tempfile
 
 import re
+import numpy as np
 import torch
 
+from hashlib import sha256
+from itertools import chain
+
 from torch.utils.data import Dataset
 from transformers import GPT2Tokenizer
 
+from utils import TOKEN_CACHE
+
 
 def preprocess_string(s):
   return ' '.join(s.lower()
@@ -24,37 +35,108 @@ def preprocess_string(s):
                   .split())
 
 
+def content_hash(*parts):
+  """sha256 hex digest of some strings or bytes: the key of a cache derived from exactly these inputs."""
+  digest = sha256()
+  for part in parts:
+    digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+    digest.update(b'\0')
+  return digest.hexdigest()
+
+
+class TokenCache:
+  """
+  The token ids of a list of texts, tokenized once into TOKEN_CACHE/<hash>/: ids.bin holds every text's ids back to
+  back as a flat int32 np.memmap, and offsets.npy [num_texts + 1] where text i is ids[offsets[i]:offsets[i + 1]].
+  The hash covers the texts themselves and the tokenizer, so editing the source file or the prompt template the
+  texts are built from selects a new cache rather than reading a stale one. Indexing returns a read-only view of
+  the memmap: nothing is tokenized or copied while iterating over a dataset.
+  """
+
+  def __init__(self, texts, tokenizer, cache_dir=TOKEN_CACHE):
+    key = content_hash(type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer), tokenizer.model_max_length,
+                       *texts)
+    self.path = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(self.path, 'offsets.npy')):
+      self._build(texts, tokenizer, cache_dir)
+    self.offsets = np.load(os.path.join(self.path, 'offsets.npy'))
+    self.ids = np.memmap(os.path.join(self.path, 'ids.bin'), dtype=np.int32, mode='r')
+
+  def _build(self, texts, tokenizer, cache_dir):
+    input_ids = tokenizer(list(texts), truncation=True)['input_ids']
+    offsets = np.cumsum([0] + [len(ids) for ids in input_ids], dtype=np.int64)
+    # Written to a scratch directory that is then renamed into place, so an interrupted run never leaves a
+    # partial cache behind.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir)
+    ids = np.fromiter(chain.from_iterable(input_ids), dtype=np.int32, count=int(offsets[-1]))
+    ids.tofile(os.path.join(tmp_path, 'ids.bin'))
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    try:
+      os.rename(tmp_path, self.path)
+    except OSError:
+      shutil.rmtree(tmp_path)  # another process built the same cache first
+    print(f"Tokenized {len(input_ids)} texts into {self.path}")
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def lengths(self):
+    """The number of tokens of every text: [num_texts]."""
+    return np.diff(self.offsets)
+
+  def __getitem__(self, idx):
+    return self.ids[self.offsets[idx]:self.offsets[idx + 1]]
+
+
+def collate_token_ids(token_ids, pad_token_id, packed=False):
+  """
+  Batches the 1-D token id arrays of some texts (TokenCache entries) into 'token_ids' and 'attention_mask', right
+  padded with pad_token_id to the longest text. With packed=True the texts are concatenated instead: 'token_ids' is
+  the 1-D stream [total] and 'cu_seqlens' [batch_size + 1] holds the offset of each text, see GPT2Model.forward.
+  No position in a packed batch is padding.
+  """
+  lengths = torch.LongTensor([len(ids) for ids in token_ids])
+  if packed:
+    token_ids = torch.from_numpy(np.concatenate(token_ids).astype(np.int64))
+    cu_seqlens = torch.cat([torch.zeros(1, dtype=torch.long), lengths.cumsum(0)])
+    return {'token_ids': token_ids, 'attention_mask': torch.ones_like(token_ids), 'cu_seqlens': cu_seqlens}
+
+  batch = np.full((len(token_ids), int(lengths.max())), pad_token_id, dtype=np.int64)
+  for row, ids in zip(batch, token_ids):
+    row[:len(ids)] = ids
+  attention_mask = (torch.arange(batch.shape[1])[None, :] < lengths[:, None]).long()
+  return {'token_ids': torch.from_numpy(batch), 'attention_mask': attention_mask}
+
+
+def cloze_prompt(s1, s2):
+  # same prompt format for train, dev and test so the model sees consistent inputs
+  return f'Is "{s1}" a paraphrase of "{s2}"? Answer "yes" or "no": '
+
+
 class ParaphraseDetectionDataset(Dataset):
   def __init__(self, dataset, args):
     self.dataset = dataset
     self.p = args
+    self.packed = getattr(args, 'packed', False)
     self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
     self.tokenizer.pad_token = self.tokenizer.eos_token
+    self.token_cache = TokenCache([cloze_prompt(x[0], x[1]) for x in dataset], self.tokenizer)
 
   def __len__(self):
     return len(self.dataset)
 
   def __getitem__(self, idx):
-    return self.dataset[idx]
+    return (*self.dataset[idx], self.token_cache[idx])
 
   def collate_fn(self, all_data):
-    sent1 = [x[0] for x in all_data]
-    sent2 = [x[1] for x in all_data]
     # just use 0/1 labels for cross entropy, not token ids
     labels = torch.LongTensor([x[2] for x in all_data])
     sent_ids = [x[3] for x in all_data]
-
-    # same prompt format as test so the model sees consistent inputs
-    cloze_style_sents = [f'Is "{s1}" a paraphrase of "{s2}"? Answer "yes" or "no": ' for
-                         (s1, s2) in zip(sent1, sent2)]
-    encoding = self.tokenizer(cloze_style_sents, return_tensors='pt', padding=True, truncation=True)
-
-    token_ids = torch.LongTensor(encoding['input_ids'])
-    attention_mask = torch.LongTensor(encoding['attention_mask'])
+    token_ids = [x[4] for x in all_data]
 
     batched_data = {
-      'token_ids': token_ids,
-      'attention_mask': attention_mask,
+      **collate_token_ids(token_ids, self.tokenizer.pad_token_id, packed=self.packed),
       'labels': labels,
       'sent_ids': sent_ids
     }
@@ -66,38 +148,52 @@ class ParaphraseDetectionTestDataset(Dataset):
   def __init__(self, dataset, args):
     self.dataset = dataset
     self.p = args
+    self.packed = getattr(args, 'packed', False)
     self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
     self.tokenizer.pad_token = self.tokenizer.eos_token
+    self.token_cache = TokenCache([cloze_prompt(x[0], x[1]) for x in dataset], self.tokenizer)
 
   def __len__(self):
     return len(self.dataset)
 
   def __getitem__(self, idx):
-    return self.dataset[idx]
+    return (*self.dataset[idx], self.token_cache[idx])
 
   def collate_fn(self, all_data):
-    sent1 = [x[0] for x in all_data]
-    sent2 = [x[1] for x in all_data]
     sent_ids = [x[2] for x in all_data]
-
-    cloze_style_sents = [f'Is "{s1}" a paraphrase of "{s2}"? Answer "yes" or "no": ' for (s1, s2) in
-                         zip(sent1, sent2)]
-
-    encoding = self.tokenizer(cloze_style_sents, return_tensors='pt', padding=True, truncation=True)
-
-    token_ids = torch.LongTensor(encoding['input_ids'])
-    attention_mask = torch.LongTensor(encoding['attention_mask'])
+    token_ids = [x[3] for x in all_data]
 
     batched_data = {
-      'token_ids': token_ids,
-      'attention_mask': attention_mask,
+      **collate_token_ids(token_ids, self.tokenizer.pad_token_id, packed=self.packed),
       'sent_ids': sent_ids
     }
 
     return batched_data
 
 
-def load_paraphrase_data(paraphrase_filename, split='train'):
+def load_paraphrase_data(paraphrase_filename, split='train', cache_dir=TOKEN_CACHE):
+  """
+  The preprocessed examples of a split. They are parsed once and kept as JSON in cache_dir, keyed by the file's
+  content, the split and preprocess_string, so later runs skip the CSV parsing.
+  """
+  with open(paraphrase_filename, 'rb') as fp:
+    key = content_hash(fp.read(), split, inspect.getsource(preprocess_string))
+  cache_file = os.path.join(cache_dir, f'paraphrase-{key}.json')
+  if os.path.exists(cache_file):
+    with open(cache_file, 'r') as fp:
+      paraphrase_data = [tuple(record) for record in json.load(fp)]
+  else:
+    paraphrase_data = _parse_paraphrase_data(paraphrase_filename, split)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.json', delete=False) as fp:
+      json.dump(paraphrase_data, fp)
+    os.replace(fp.name, cache_file)
+
+  print(f"Loaded {len(paraphrase_data)} {split} examples from {paraphrase_filename}")
+  return paraphrase_data
+
+
+def _parse_paraphrase_data(paraphrase_filename, split):
   paraphrase_data = []
   if split == 'test':
     with open(paraphrase_filename, 'r') as fp:
@@ -118,7 +214,6 @@ def load_paraphrase_data(paraphrase_filename, split='train'):
         except:
           pass
 
-  print(f"Loaded {len(paraphrase_data)} {split} examples from {paraphrase_filename}")
   return paraphrase_data
 
 
@@ -128,6 +223,7 @@ class SonnetsDataset(Dataset):
 
     self.tokenizer.pad_token = self.tokenizer.eos_token
     self.sonnets = self._load_sonnets(file_path)
+    self.token_cache = TokenCache(self.sonnets, self.tokenizer)
 
   def _load_sonnets(self, file_path):
     """Reads the file and extracts individual sonnets."""
@@ -148,15 +244,57 @@ class SonnetsDataset(Dataset):
 
   def collate_fn(self, all_data):
     idx = [example[0] for example in all_data]
-    sonnets = [example[1] for example in all_data]
+    token_ids = [self.token_cache[i] for i in idx]
+
+    batched_data = {
+      **collate_token_ids(token_ids, self.tokenizer.pad_token_id),
+      'sent_ids': idx
+    }
+
+    return batched_data
 
-    encoding = self.tokenizer(sonnets, return_tensors='pt', padding=True, truncation=True)
-    token_ids = torch.LongTensor(encoding['input_ids'])
-    attention_mask = torch.LongTensor(encoding['attention_mask'])
+
+class PackedSonnetsDataset(Dataset):
+  """
+  Sonnets for language-model training as blocks of block_size tokens. The cached ids of every sonnet, each followed
+  by an EOS separator, are concatenated into one stream and cut into blocks, so batches hold no padding at all.
+
+  Batches are packed (see collate_token_ids). With reset_attention each block is further split after every EOS, so a
+  token only attends within its own sonnet; otherwise every block is one sequence that attends across sonnets.
+  """
+
+  def __init__(self, file_path, block_size=256, reset_attention=True):
+    sonnets = SonnetsDataset(file_path)
+    self.tokenizer = sonnets.tokenizer
+    eos = self.tokenizer.eos_token_id
+    self.stream = np.concatenate([np.append(sonnets.token_cache[i], eos) for i in range(len(sonnets))])
+    self.starts = np.arange(0, len(self.stream), block_size)
+    self.ends = np.minimum(self.starts + block_size, len(self.stream))
+    # Stream positions where a sonnet begins (just after its predecessor's EOS).
+    self.doc_starts = np.flatnonzero(self.stream == eos) + 1 if reset_attention else np.zeros(0, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def lengths(self):
+    return self.ends - self.starts
+
+  def __getitem__(self, idx):
+    start, end = self.starts[idx], self.ends[idx]
+    inner = self.doc_starts[(self.doc_starts > start) & (self.doc_starts < end)]
+    seqlens = np.diff(np.concatenate([[start], inner, [end]]))
+    return (idx, self.stream[start:end], seqlens)
+
+  def collate_fn(self, all_data):
+    idx = [example[0] for example in all_data]
+    token_ids = torch.from_numpy(np.concatenate([example[1] for example in all_data]).astype(np.int64))
+    seqlens = torch.from_numpy(np.concatenate([example[2] for example in all_data]))
+    cu_seqlens = torch.cat([torch.zeros(1, dtype=torch.long), seqlens.cumsum(0)])
 
     batched_data = {
       'token_ids': token_ids,
-      'attention_mask': attention_mask,
+      'attention_mask': torch.ones_like(token_ids),
+      'cu_seqlens': cu_seqlens,
       'sent_ids': idx
     }
 
@@ -0,0 +1,91 @@
+import os
+import tempfile
+
+import numpy as np
+from transformers import GPT2Tokenizer
+
+from datasets import PackedSonnetsDataset, TokenCache
+
+TEXTS = [
+  "Shall I compare thee to a summer's day?",
+  '',
+  'Thou art more lovely and more temperate: rough winds do shake the darling buds of May, and summer\'s lease '
+  'hath all too short a date.',
+]
+
+
+def test_token_cache():
+  tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+  with tempfile.TemporaryDirectory() as cache_dir:
+    cache = TokenCache(TEXTS, tokenizer, cache_dir=cache_dir)
+    expected = [tokenizer(text)['input_ids'] for text in TEXTS]
+    assert len(cache) == len(TEXTS)
+    assert [cache[i].tolist() for i in range(len(cache))] == expected
+    assert cache.lengths().tolist() == [len(ids) for ids in expected]
+
+    # The same texts and tokenizer read the existing cache; any change to either builds a new one.
+    assert TokenCache(TEXTS, tokenizer, cache_dir=cache_dir).path == cache.path
+    edited = TokenCache(TEXTS[:-1] + [TEXTS[-1] + '!'], tokenizer, cache_dir=cache_dir)
+    tokenizer.model_max_length = 16
+    truncated = TokenCache(TEXTS, tokenizer, cache_dir=cache_dir)
+    paths = [cache.path, edited.path, truncated.path]
+    assert len(set(paths)) == 3
+    assert sorted(os.listdir(cache_dir)) == sorted(os.path.basename(path) for path in paths)
+    assert edited[2].tolist() == tokenizer(TEXTS[2] + '!', truncation=False)['input_ids']
+    assert truncated.lengths().tolist() == [len(ids[:16]) for ids in expected]
+
+
+SONNETS = """Sonnets
+
+1
+
+From fairest creatures we desire increase,
+That thereby beauty's rose might never die,
+
+2
+
+When forty winters shall besiege thy brow,
+And dig deep trenches in thy beauty's field,
+
+3
+
+Look in thy glass and tell the face thou viewest
+"""
+
+
+def test_packed_sonnets_dataset():
+  tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+  eos = tokenizer.eos_token_id
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    file_path = os.path.join(tmp_dir, 'sonnets.txt')
+    with open(file_path, 'w', encoding='utf-8') as fp:
+      fp.write(SONNETS)
+    sonnets = SONNETS.split('\n\n')[2::2]
+    stream = sum((tokenizer(sonnet.strip())['input_ids'] + [eos] for sonnet in sonnets), [])
+
+    for reset_attention in (True, False):
+      dataset = PackedSonnetsDataset(file_path, block_size=8, reset_attention=reset_attention)
+      assert len(dataset) == -(-len(stream) // 8)
+      assert dataset.lengths().sum() == len(stream)
+      batch = dataset.collate_fn([dataset[i] for i in range(len(dataset))])
+      # The blocks, back to back, are the EOS-joined sonnets.
+      assert batch['token_ids'].tolist() == stream
+      assert batch['attention_mask'].all()
+
+      # Every sequence ends at an EOS or a block edge. With reset_attention none holds an EOS before its last
+      # token; without it, the sequences are the blocks.
+      cu_seqlens = batch['cu_seqlens'].tolist()
+      if not reset_attention:
+        assert cu_seqlens == [0] + dataset.ends.tolist()
+      token_ids = np.array(stream)
+      block_edges = set(dataset.ends.tolist())
+      assert cu_seqlens[0] == 0 and cu_seqlens[-1] == len(stream)
+      for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+        assert end > start
+        assert token_ids[end - 1] == eos or end in block_edges
+        assert not (token_ids[start:end - 1] == eos).any() or not reset_attention
+
+if __name__ == '__main__':
+  test_token_cache()
+  test_packed_sonnets_dataset()
+  print("Dataset tests passed!")
@@ -12,12 +12,13 @@ from sacrebleu.metrics import CHRF
 from datasets import (
   SonnetsDataset,
 )
+from utils import autocast_context, batch_cu_seqlens
 
 TQDM_DISABLE = False
 
 
 @torch.no_grad()
-def model_eval_paraphrase(dataloader, model, device):
+def model_eval_paraphrase(dataloader, model, device, precision='fp32'):
   model.eval()  # Switch to eval model, will turn off randomness like dropout.
   y_true, y_pred, sent_ids = [], [], []
   for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
@@ -26,8 +27,11 @@ def model_eval_paraphrase(dataloader, model, device):
 
     b_ids = b_ids.to(device)
     b_mask = b_mask.to(device)
+    b_cu_seqlens = batch_cu_seqlens(batch, device)
 
-    logits = model(b_ids, b_mask).cpu().numpy()
+    with autocast_context(device, precision):
+      logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
+    logits = logits.float().cpu().numpy()
     preds = np.argmax(logits, axis=1).flatten()
 
     y_true.extend(labels)
@@ -41,7 +45,7 @@ def model_eval_paraphrase(dataloader, model, device):
 
 
 @torch.no_grad()
-def model_test_paraphrase(dataloader, model, device):
+def model_test_paraphrase(dataloader, model, device, precision='fp32'):
   model.eval()  # Switch to eval model, will turn off randomness like dropout.
   y_true, y_pred, sent_ids = [], [], []
   for step, batch in enumerate(tqdm(dataloader, desc=f'eval', disable=TQDM_DISABLE)):
@@ -49,8 +53,11 @@ def model_test_paraphrase(dataloader, model, device):
 
     b_ids = b_ids.to(device)
     b_mask = b_mask.to(device)
+    b_cu_seqlens = batch_cu_seqlens(batch, device)
 
-    logits = model(b_ids, b_mask).cpu().numpy()
+    with autocast_context(device, precision):
+      logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
+    logits = logits.float().cpu().numpy()
     preds = np.argmax(logits, axis=1).flatten()
 
     y_pred.extend(preds)
@@ -0,0 +1,214 @@
+import torch
+
+from config import GPT2Config
+from models.gpt2 import GPT2Model
+
+SEED = 0
+
+
+def tiny_model(**kwargs) -> GPT2Model:
+  """A randomly initialised GPT-2 small enough to check numerics without downloading weights."""
+  torch.manual_seed(SEED)
+  config = GPT2Config(vocab_size=100, hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                      intermediate_size=128, max_position_embeddings=64, **kwargs)
+  return GPT2Model(config).eval()
+
+
+@torch.no_grad()
+def test_kv_cache():
+  model = tiny_model()
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  full = model(input_ids, attention_mask)['last_hidden_state']
+
+  # Encode a prefix, then feed the remaining tokens one at a time through the cache.
+  outputs = model(input_ids[:, :6], attention_mask[:, :6], use_cache=True)
+  steps = [outputs['last_hidden_state']]
+  for t in range(6, 10):
+    outputs = model(input_ids[:, t:t + 1], attention_mask[:, :t + 1],
+                    past_key_values=outputs['past_key_values'], use_cache=True)
+    steps.append(outputs['last_hidden_state'])
+  incremental = torch.cat(steps, dim=1)
+
+  assert torch.allclose(full, incremental, atol=1e-5)
+
+
+@torch.no_grad()
+def test_fused_qkv():
+  model = tiny_model()
+  fused = tiny_model(fused_qkv=True)
+  # Checkpoints load across layouts in both directions.
+  fused.load_state_dict(model.state_dict())
+  model.load_state_dict(fused.state_dict())
+
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, 7:] = 0
+  expected = model(input_ids, attention_mask)['last_hidden_state']
+  actual = fused(input_ids, attention_mask)['last_hidden_state']
+  assert torch.allclose(expected, actual, atol=1e-5)
+
+
+def test_attention_backends():
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, 7:] = 0
+  reference = tiny_model()
+  expected = reference(input_ids, attention_mask)['last_hidden_state']
+  expected.sum().backward()
+
+  for backend in ('sdpa', 'chunked'):
+    model = tiny_model(attention_backend=backend, attention_chunk_size=3)
+    actual = model(input_ids, attention_mask)['last_hidden_state']
+    assert torch.allclose(expected, actual, atol=1e-5), backend
+    actual.sum().backward()
+    for (name, p), q in zip(model.named_parameters(), reference.parameters()):
+      assert torch.allclose(p.grad, q.grad, atol=1e-4), (backend, name)
+
+    # The backends must also agree when decoding against a cache.
+    with torch.no_grad():
+      prefix = model(input_ids[:, :6], attention_mask[:, :6], use_cache=True)
+      step = model(input_ids[:, 6:], attention_mask, past_key_values=prefix['past_key_values'])
+      assert torch.allclose(expected[:, 6:], step['last_hidden_state'], atol=1e-5), backend
+
+
+@torch.no_grad()
+def test_padding_mask():
+  model = tiny_model()
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, 7:] = 0
+  padded = model(input_ids, attention_mask)
+  alone = model(input_ids[:1, :7], attention_mask[:1, :7])
+  assert torch.allclose(padded['last_hidden_state'][:1, :7], alone['last_hidden_state'], atol=1e-5)
+  assert torch.allclose(padded['last_token'][:1], alone['last_token'], atol=1e-5)
+
+
+@torch.no_grad()
+def test_left_padding():
+  model = tiny_model()
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, :4] = 0
+  position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+  padded = model(input_ids, attention_mask, position_ids=position_ids, use_cache=True)
+  alone = model(input_ids[:1, 4:], attention_mask[:1, 4:])
+  assert torch.allclose(padded['last_token'][:1], alone['last_token'], atol=1e-5)
+
+  # Decoding continues from each row's own position.
+  next_ids = torch.randint(0, 100, (2, 1))
+  step = model(next_ids, torch.cat([attention_mask, torch.ones_like(next_ids)], dim=1),
+               past_key_values=padded['past_key_values'], position_ids=position_ids[:, -1:] + 1,
+               return_last_token_only=True)
+  alone = model(torch.cat([input_ids[:1, 4:], next_ids[:1]], dim=1), torch.ones(1, 7, dtype=torch.long))
+  assert torch.allclose(step['last_token'][:1], alone['last_token'], atol=1e-5)
+
+
+def test_packed_sequences():
+  lengths = [7, 10, 3]
+  input_ids = torch.randint(0, 100, (3, 10))
+  attention_mask = (torch.arange(10)[None, :] < torch.tensor(lengths)[:, None]).long()
+  packed_ids = input_ids[attention_mask.bool()]
+  cu_seqlens = torch.tensor([0, 7, 17, 20])
+
+  for backend in ('reference', 'sdpa', 'chunked'):
+    model = tiny_model(attention_backend=backend, attention_chunk_size=4)
+    padded = model(input_ids, attention_mask)
+    packed = model(packed_ids, torch.ones_like(packed_ids), cu_seqlens=cu_seqlens)
+    assert torch.allclose(padded['last_hidden_state'][attention_mask.bool()], packed['last_hidden_state'], atol=1e-5)
+    assert torch.allclose(padded['last_token'], packed['last_token'], atol=1e-5), backend
+
+    # Gradients flow through the scatter into blocks and back.
+    params = list(model.gpt_layers.parameters())
+    expected = torch.autograd.grad(padded['last_token'].sum(), params)
+    actual = torch.autograd.grad(packed['last_token'].sum(), params)
+    assert all(torch.allclose(g, h, atol=1e-5) for g, h in zip(expected, actual)), backend
+
+
+def test_last_token_only():
+  input_ids = torch.randint(0, 100, (3, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, 7:] = 0
+  attention_mask[2, 3:] = 0
+  cu_seqlens = torch.tensor([0, 7, 17, 20])
+
+  for kwargs in ({}, {'fused_qkv': True}, {'attention_backend': 'sdpa'}, {'attention_backend': 'chunked'}):
+    model = tiny_model(**kwargs)
+    expected = model(input_ids, attention_mask)['last_token']
+    outputs = model(input_ids, attention_mask, return_last_token_only=True)
+    assert 'last_hidden_state' not in outputs
+    assert torch.allclose(expected, outputs['last_token'], atol=1e-5), kwargs
+    packed = model(input_ids[attention_mask.bool()], None, cu_seqlens=cu_seqlens, return_last_token_only=True)
+    assert torch.allclose(expected, packed['last_token'], atol=1e-5), kwargs
+
+    # Decoding against a cache only queries the new last token as well.
+    with torch.no_grad():
+      prefix = model(input_ids[1:, :6], attention_mask[1:, :6], use_cache=True)
+      step = model(input_ids[1:, 6:], attention_mask[1:], past_key_values=prefix['past_key_values'],
+                   return_last_token_only=True)
+      assert torch.allclose(expected[1:2], step['last_token'][:1], atol=1e-5), kwargs
+
+
+def test_gradient_checkpointing():
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  results = []
+  for kwargs in ({}, {'gradient_checkpointing': True},
+                 {'gradient_checkpointing': True, 'checkpoint_budget_mb': 0.01}):
+    model = tiny_model(**kwargs).train()  # dropout on: the recomputation must replay the same masks
+    torch.manual_seed(SEED)
+    output = model(input_ids, attention_mask)['last_hidden_state']
+    output.sum().backward()
+    results.append((output, [p.grad for p in model.parameters()]))
+
+  expected_output, expected_grads = results[0]
+  for output, grads in results[1:]:
+    assert torch.equal(expected_output, output)
+    assert all(torch.allclose(g, h, atol=1e-6) for g, h in zip(expected_grads, grads))
+
+  model = tiny_model(gradient_checkpointing=True, checkpoint_every=2)
+  assert model.checkpointed_layers(torch.zeros(2, 10, 32)) == {0}
+
+
+@torch.no_grad()
+def test_load_on_meta():
+  import os, tempfile
+  from utils import load_on_meta
+  model = tiny_model()
+  input_ids = torch.randint(0, 100, (2, 10))
+  attention_mask = torch.ones_like(input_ids)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    filepath = os.path.join(tmp_dir, 'model.pt')
+    torch.save(model.state_dict(), filepath)
+    state_dict = torch.load(filepath, mmap=True, weights_only=True)
+    loaded = load_on_meta(lambda: GPT2Model(model.config), state_dict).eval()
+    assert not any(t.is_meta for t in list(loaded.parameters()) + list(loaded.buffers()))
+    assert torch.equal(model(input_ids, attention_mask)['last_hidden_state'],
+                       loaded(input_ids, attention_mask)['last_hidden_state'])
+
+
+@torch.no_grad()
+def test_int4_linear():
+  from modules.int4_linear import Int4Linear
+  torch.manual_seed(SEED)
+  linear = torch.nn.Linear(64, 8)
+  int4_linear = Int4Linear.from_linear(linear, group_size=16)
+  # Dequantized weights are within half a quantization step of the originals.
+  step = (int4_linear.scales.float().repeat_interleave(16, dim=1))
+  assert torch.all((int4_linear.dequantize() - linear.weight).abs() <= step / 2 + 1e-3)
+  x = torch.randn(3, 64)
+  assert torch.allclose(int4_linear(x), linear(x), atol=0.1)
+
+
+if __name__ == '__main__':
+  test_kv_cache()
+  test_fused_qkv()
+  test_attention_backends()
+  test_padding_mask()
+  test_left_padding()
+  test_packed_sequences()
+  test_last_token_only()
+  test_gradient_checkpointing()
+  test_load_on_meta()
+  test_int4_linear()
+  print("GPT-2 tests passed!")
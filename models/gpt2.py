@@ -1,11 +1,15 @@
+import os
+
 import torch
 from torch import nn
-from transformers import GPT2Model as OpenAIGPT2Model
+from torch.utils.checkpoint import checkpoint
 
 from config import GPT2Config
 from models.base_gpt import GPTPreTrainedModel
+from modules.attention import PackedSequences
 from modules.gpt2_layer import GPT2Layer
-from utils import get_extended_attention_mask
+from modules.layer_norm import LayerNorm
+from utils import CONVERTED_WEIGHTS_CACHE, load_on_meta
 
 
 class GPT2Model(GPTPreTrainedModel):
@@ -31,6 +35,8 @@ class GPT2Model(GPTPreTrainedModel):
     position_ids = torch.arange(config.max_position_embeddings).unsqueeze(0)
     self.register_buffer('position_ids', position_ids)
 
+    self.init_non_persistent_buffers()
+
     # GPT-2 layers.
     self.gpt_layers = nn.ModuleList([GPT2Layer(config) for _ in range(config.num_hidden_layers)])
 
@@ -39,11 +45,21 @@ class GPT2Model(GPTPreTrainedModel):
     self.pooler_af = nn.Tanh()
 
     # Final layer norm.
-    self.final_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+    self.final_layer_norm = LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+
+    # Optional untied output projection; only set by quantization, which cannot share the embedding weight.
+    self.lm_head = None
 
     self.init_weights()
 
-  def embed(self, input_ids):
+  def init_non_persistent_buffers(self, device=None):
+    """(Re)creates the buffers that are not saved in the state dict, e.g. after building on the meta device."""
+    # Causal mask over all position pairs (True = may attend); sliced per forward instead of rebuilt per layer.
+    num_positions = self.config.max_position_embeddings
+    causal_mask = torch.tril(torch.ones(num_positions, num_positions, dtype=torch.bool, device=device))
+    self.register_buffer('causal_mask', causal_mask.view(1, 1, num_positions, num_positions), persistent=False)
+
+  def embed(self, input_ids, past_length=0, position_ids=None):
     input_shape = input_ids.size()
     seq_length = input_shape[1]
 
@@ -51,8 +67,9 @@ class GPT2Model(GPTPreTrainedModel):
 
     inputs_embeds = self.word_embedding(input_ids)
 
-
-    pos_ids = self.position_ids[:, :seq_length]
+    # When decoding with a cache, the new tokens continue from position past_length. Explicit position_ids
+    # (e.g. restarting per sequence in a packed batch) take precedence.
+    pos_ids = self.position_ids[:, past_length:past_length + seq_length] if position_ids is None else position_ids
     pos_embeds = None
 
     ### TODO: Use pos_ids to get position embedding from self.pos_embedding into pos_embeds.
@@ -62,41 +79,160 @@ class GPT2Model(GPTPreTrainedModel):
     return self.embed_dropout(embeds)
 
 
-  def encode(self, hidden_states, attention_mask):
+  def get_attention_mask(self, attention_mask, query_length):
     """
-    hidden_states: the output from the embedding layer [batch_size, seq_len, hidden_size]
-    attention_mask: [batch_size, seq_len]
+    attention_mask: [batch_size, key_len], 1 for real tokens and 0 for padding
+    query_length: number of new tokens; they are the last query_length of the key_len positions
+
+    Returns a boolean [batch_size, 1, query_length, key_len] mask that is True where a query may attend.
     """
-    # Get the extended attention mask for self-attention.
-    # Returns extended_attention_mask of size [batch_size, 1, 1, seq_len].
-    # Distinguishes between non-padding tokens (with a value of 0) and padding tokens
-    # (with a value of a large negative number).
-    extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, self.dtype)
+    key_length = attention_mask.size(1)
+    causal_mask = self.causal_mask[:, :, key_length - query_length:key_length, :key_length]
+    extended_attention_mask = causal_mask & attention_mask[:, None, None, :].bool()
+    # A query that may attend to nothing (a left-padded position) would turn into NaNs in the fused kernels;
+    # let it attend everywhere instead, its output is never used.
+    return extended_attention_mask | ~extended_attention_mask.any(dim=-1, keepdim=True)
+
+  def checkpointed_layers(self, hidden_states):
+    """
+    Indices of the layers whose activations are recomputed in backward instead of stored.
 
+    With config.checkpoint_budget_mb set, as few layers as possible are checkpointed (spread evenly over
+    the stack) such that the estimated activations for this batch fit the budget. Otherwise every
+    config.checkpoint_every-th layer is.
+    """
+    num_layers = self.config.num_hidden_layers
+    if self.config.checkpoint_budget_mb is None:
+      return set(range(0, num_layers, self.config.checkpoint_every))
+
+    # Rough activation count per layer: ~17 [b, t, d] tensors (norms, q/k/v, context, MLP, dropout masks),
+    # plus the [b, h, t, t] scores/probs/dropout mask that only the reference attention backend keeps.
+    batch_size, seq_len, hidden_size = hidden_states.shape
+    element_size = hidden_states.element_size()
+    attention_elements = 3 * self.config.num_attention_heads * seq_len \
+      if self.config.attention_backend == 'reference' else 0
+    layer_bytes = element_size * batch_size * seq_len * (17 * hidden_size + attention_elements)
+    # A checkpointed layer still keeps its input, and one layer is fully materialised while it is recomputed.
+    input_bytes = element_size * batch_size * seq_len * hidden_size
+    budget = self.config.checkpoint_budget_mb * 2 ** 20 - layer_bytes - num_layers * input_bytes
+    num_stored = int(min(max(budget // (layer_bytes - input_bytes), 0), num_layers))
+    num_checkpointed = num_layers - num_stored
+    return set(i * num_layers // num_checkpointed for i in range(num_checkpointed))
+
+  def encode(self, hidden_states, attention_mask, past_key_values=None, use_cache=False, packed=None,
+             output_positions=None):
+    """
+    hidden_states: the output from the embedding layer [batch_size, seq_len, hidden_size]
+    attention_mask: [batch_size, past_len + seq_len]
+    past_key_values: optional tuple with one (key, value) pair per layer from a previous call
+    use_cache: whether to collect each layer's (key, value) pair for the next decoding step
+    packed: optional PackedSequences; hidden_states is then the packed stream [1, total, hidden_size]
+      and attention_mask is ignored.
+    output_positions: optional [batch_size, num_positions] indices into seq_len (with packed, [1, num_seqs]
+      stream indices, one per sequence). Only the final hidden states at these positions are returned and
+      the last layer computes its queries, residuals and MLP for them alone.
+
+    Returns the final hidden states and the per-layer presents (None unless use_cache is set).
+    """
+    # Combine causality and padding once for all layers: [batch_size, 1, seq_len, past_len + seq_len].
+    # Packed sequences get the same mask per sequence, over the blocks attention lays them out in.
+    if packed is not None:
+      extended_attention_mask = self.get_attention_mask(packed.padding_mask, packed.max_len)
+    else:
+      extended_attention_mask = self.get_attention_mask(attention_mask, hidden_states.size(1))
+
+    # The last layer only needs the mask rows of the positions it queries.
+    last_layer_mask = extended_attention_mask
+    if output_positions is not None:
+      rows = packed.position_ids[output_positions[0]][:, None] if packed is not None else output_positions
+      last_layer_mask = torch.take_along_dim(extended_attention_mask, rows[:, None, :, None], dim=2)
+
+    # Trade compute for memory during training: checkpointed layers only keep their input and rerun
+    # their forward in backward. The RNG state is restored for the rerun, so dropout masks (and results) match.
+    checkpointed = ()
+    if self.config.gradient_checkpointing and self.training and torch.is_grad_enabled():
+      checkpointed = self.checkpointed_layers(hidden_states)
+
+    presents = () if use_cache else None
     # Pass the hidden states through the encoder layers.
     for i, layer_module in enumerate(self.gpt_layers):
+      layer_past = past_key_values[i] if past_key_values is not None else None
+      is_last = i == len(self.gpt_layers) - 1
+      layer_mask = last_layer_mask if is_last else extended_attention_mask
+      layer_positions = output_positions if is_last else None
       # Feed the encoding from the last bert_layer to the next.
-      hidden_states = layer_module(hidden_states, extended_attention_mask)
-
-    return hidden_states
-
-  def forward(self, input_ids, attention_mask):
+      if i in checkpointed:
+        hidden_states, present = checkpoint(layer_module, hidden_states, layer_mask, layer_past, use_cache,
+                                            packed, layer_positions, use_reentrant=False)
+      else:
+        hidden_states, present = layer_module(hidden_states, layer_mask, layer_past=layer_past, use_cache=use_cache,
+                                              packed=packed, output_positions=layer_positions)
+      if use_cache:
+        presents = presents + (present,)
+
+    return hidden_states, presents
+
+  def forward(self, input_ids, attention_mask, past_key_values=None, use_cache=False, cu_seqlens=None,
+              return_last_token_only=False, position_ids=None):
     """
     input_ids: [batch_size, seq_len], seq_len is the max length of the batch
-    attention_mask: same size as input_ids, 1 represents non-padding tokens, 0 represents padding tokens
+    attention_mask: same size as input_ids, 1 represents non-padding tokens, 0 represents padding tokens.
+      When past_key_values is given, it covers the cached tokens as well: [batch_size, past_len + seq_len].
+    past_key_values: the 'past_key_values' returned by a previous call with use_cache=True. input_ids
+      then only holds the tokens that come after the cached ones.
+    use_cache: also return 'past_key_values' so that decoding can continue one token at a time.
+    cu_seqlens: for a padding-free batch, input_ids is instead the packed stream of all sequences [total]
+      and cu_seqlens [num_seqs + 1] holds the offset of each one (attention_mask is then ignored).
+      'last_hidden_state' is the packed [total, hidden_size] and 'last_token' is [num_seqs, hidden_size].
+    return_last_token_only: only compute what 'last_token' needs. The last layer then runs its queries, MLP
+      and the final layer norm for the last tokens alone, and 'last_hidden_state' is not returned.
+    position_ids: optional [batch_size, seq_len] positions of input_ids. They default to consecutive positions
+      after the cached ones, which is wrong for left-padded rows: those should count real tokens only.
     """
+    if cu_seqlens is not None:
+      return self.forward_packed(input_ids, cu_seqlens, use_cache=use_cache,
+                                 return_last_token_only=return_last_token_only)
+
+    past_length = past_key_values[0][0].size(-2) if past_key_values is not None else 0
+    # Index of the final real token, with padding on either side. The mask counts cached tokens too, so shift
+    # the index back into the new tokens (rows whose last real token is cached fall back to 0).
+    key_positions = torch.arange(attention_mask.size(1), device=attention_mask.device)
+    last_non_pad_idx = ((attention_mask * key_positions).argmax(dim=1) - past_length).clamp(min=0)
+
     # Get the embedding for each input token.
-    embedding_output = self.embed(input_ids=input_ids)
+    embedding_output = self.embed(input_ids=input_ids, past_length=past_length, position_ids=position_ids)
 
     # Feed to a transformer (a stack of GPTLayers).
-    sequence_output = self.encode(embedding_output, attention_mask=attention_mask)
+    output_positions = last_non_pad_idx[:, None] if return_last_token_only else None
+    sequence_output, presents = self.encode(embedding_output, attention_mask=attention_mask,
+                                            past_key_values=past_key_values, use_cache=use_cache,
+                                            output_positions=output_positions)
     sequence_output = self.final_layer_norm(sequence_output)
 
-    # Get the hidden state of the final token.
-    last_non_pad_idx = attention_mask.sum(dim=1) - 1  # Subtract 1 to get last index
-    last_token = sequence_output[torch.arange(sequence_output.shape[0]), last_non_pad_idx]
-
-    return {'last_hidden_state': sequence_output, 'last_token': last_token}
+    if return_last_token_only:
+      outputs = {'last_token': sequence_output[:, 0]}
+    else:
+      # Get the hidden state of the final token.
+      last_token = sequence_output[torch.arange(sequence_output.shape[0]), last_non_pad_idx]
+      outputs = {'last_hidden_state': sequence_output, 'last_token': last_token}
+    if use_cache:
+      outputs['past_key_values'] = presents
+    return outputs
+
+  def forward_packed(self, input_ids, cu_seqlens, use_cache=False, return_last_token_only=False):
+    """The padding-free path of forward, see cu_seqlens there."""
+    if use_cache:
+      raise ValueError('use_cache is not supported for packed sequences.')
+    packed = PackedSequences(cu_seqlens)
+    # The last token of each sequence sits right before the start of the next.
+    last_positions = cu_seqlens[1:] - 1
+    embedding_output = self.embed(input_ids=input_ids[None], position_ids=packed.position_ids[None])
+    sequence_output, _ = self.encode(embedding_output, attention_mask=None, packed=packed,
+                                     output_positions=last_positions[None] if return_last_token_only else None)
+    sequence_output = self.final_layer_norm(sequence_output[0])
+    if return_last_token_only:
+      return {'last_token': sequence_output}
+    return {'last_hidden_state': sequence_output, 'last_token': sequence_output[last_positions]}
 
   def hidden_state_to_token(self, hidden_state):
     """
@@ -104,50 +240,85 @@ class GPT2Model(GPTPreTrainedModel):
     and the word embedding weights:
 
       return hidden_state(s) * E^T
+
+    A quantized model carries its own copy of E in lm_head instead.
     """
+    if self.lm_head is not None:
+      return self.lm_head(hidden_state)
     return torch.matmul(hidden_state, self.word_embedding.weight.transpose(0, 1))
 
 
   @classmethod
-  def from_pretrained(cls, model='gpt2', d=768, l=12, num_heads=12):
-    gpt_model = OpenAIGPT2Model.from_pretrained(model).eval()
-    our_model = GPT2Model(GPT2Config(hidden_size=d, num_hidden_layers=l,num_attention_heads=num_heads,
-                                     intermediate_size=d*3)).eval()
+  def from_size(cls, d=768, l=12, num_heads=12, **kwargs):
+    """A randomly initialised GPT-2 of the given size; extra kwargs (e.g. fused_qkv=True) are passed to GPT2Config."""
+    return cls(GPT2Config(hidden_size=d, num_hidden_layers=l, num_attention_heads=num_heads,
+                          intermediate_size=d*4, **kwargs))
+
+  @classmethod
+  def from_pretrained(cls, model='gpt2', d=768, l=12, num_heads=12, **kwargs):
+    """
+    GPT-2 with HuggingFace's pretrained weights; extra kwargs (e.g. fused_qkv=True) are passed to GPT2Config.
+
+    The first call converts the HuggingFace checkpoint and caches it in CONVERTED_WEIGHTS_CACHE. After that
+    the model is built on the meta device and the cached weights are memory-mapped in, without importing
+    transformers or holding a second copy of the model.
+    """
+    filepath = os.path.join(CONVERTED_WEIGHTS_CACHE, f'{model}.pt')
+    if not os.path.exists(filepath):
+      cls.convert_pretrained(filepath, model, d, l, num_heads)
+    state_dict = torch.load(filepath, map_location='cpu', mmap=True, weights_only=True)
+    return load_on_meta(lambda: cls.from_size(d=d, l=l, num_heads=num_heads, **kwargs), state_dict).eval()
+
+  @classmethod
+  @torch.no_grad()
+  def convert_pretrained(cls, filepath, model='gpt2', d=768, l=12, num_heads=12):
+    """Remaps HuggingFace's GPT-2 weights to our layout and saves the state dict to filepath."""
+    from transformers import GPT2Model as OpenAIGPT2Model
+    gpt_state_dict = OpenAIGPT2Model.from_pretrained(model).state_dict()
+    our_model = cls.from_size(d=d, l=l, num_heads=num_heads)
 
     # Load word and positional embeddings.
-    our_model.word_embedding.load_state_dict(gpt_model.wte.state_dict())
-    our_model.pos_embedding.load_state_dict(gpt_model.wpe.state_dict())
+    our_model.word_embedding.weight.data = gpt_state_dict['wte.weight']
+    our_model.pos_embedding.weight.data = gpt_state_dict['wpe.weight']
 
     for i in range(l):
       l = our_model.gpt_layers[i]
-      # Remap the Q,K,V weights from a conv1d to 3 linear projections
-      l.self_attention.query.weight.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.weight'][:, :d].T
-      l.self_attention.query.bias.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.bias'][:d]
-      l.self_attention.key.weight.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.weight'][:, d:d*2].T
-      l.self_attention.key.bias.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.bias'][d:d*2]
-      l.self_attention.value.weight.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.weight'][:, d*2:].T
-      l.self_attention.value.bias.data = gpt_model.state_dict()[f'h.{i}.attn.c_attn.bias'][d*2:]
+      # Remap the Q,K,V weights from a conv1d to 3 linear projections (the fused layout is repacked on load).
+      c_attn_weight = gpt_state_dict[f'h.{i}.attn.c_attn.weight']
+      c_attn_bias = gpt_state_dict[f'h.{i}.attn.c_attn.bias']
+      l.self_attention.query.weight.data = c_attn_weight[:, :d].T
+      l.self_attention.query.bias.data = c_attn_bias[:d]
+      l.self_attention.key.weight.data = c_attn_weight[:, d:d*2].T
+      l.self_attention.key.bias.data = c_attn_bias[d:d*2]
+      l.self_attention.value.weight.data = c_attn_weight[:, d*2:].T
+      l.self_attention.value.bias.data = c_attn_bias[d*2:]
 
       # Remap final dense layer in MHA.
-      l.attention_dense.weight.data = gpt_model.state_dict()[f'h.{i}.attn.c_proj.weight'].T
-      l.attention_dense.bias.data = gpt_model.state_dict()[f'h.{i}.attn.c_proj.bias']
+      l.attention_dense.weight.data = gpt_state_dict[f'h.{i}.attn.c_proj.weight'].T
+      l.attention_dense.bias.data = gpt_state_dict[f'h.{i}.attn.c_proj.bias']
 
       # Remap attention layer norm.
-      l.attention_layer_norm.weight.data = gpt_model.state_dict()[f'h.{i}.ln_1.weight']
-      l.attention_layer_norm.bias.data = gpt_model.state_dict()[f'h.{i}.ln_1.bias']
+      l.attention_layer_norm.weight.data = gpt_state_dict[f'h.{i}.ln_1.weight']
+      l.attention_layer_norm.bias.data = gpt_state_dict[f'h.{i}.ln_1.bias']
 
       # Remap post-attention MLP layers.
-      l.interm_dense.weight.data = gpt_model.state_dict()[f'h.{i}.mlp.c_fc.weight'].T
-      l.interm_dense.bias.data = gpt_model.state_dict()[f'h.{i}.mlp.c_fc.bias']
-      l.out_dense.weight.data = gpt_model.state_dict()[f'h.{i}.mlp.c_proj.weight'].T
-      l.out_dense.bias.data = gpt_model.state_dict()[f'h.{i}.mlp.c_proj.bias']
+      l.interm_dense.weight.data = gpt_state_dict[f'h.{i}.mlp.c_fc.weight'].T
+      l.interm_dense.bias.data = gpt_state_dict[f'h.{i}.mlp.c_fc.bias']
+      l.out_dense.weight.data = gpt_state_dict[f'h.{i}.mlp.c_proj.weight'].T
+      l.out_dense.bias.data = gpt_state_dict[f'h.{i}.mlp.c_proj.bias']
 
       # Remap second layer norm weights.
-      l.out_layer_norm.weight.data = gpt_model.state_dict()[f'h.{i}.ln_2.weight']
-      l.out_layer_norm.bias.data = gpt_model.state_dict()[f'h.{i}.ln_2.bias']
+      l.out_layer_norm.weight.data = gpt_state_dict[f'h.{i}.ln_2.weight']
+      l.out_layer_norm.bias.data = gpt_state_dict[f'h.{i}.ln_2.bias']
 
     # Remap the final layer norm values.
-    our_model.final_layer_norm.weight.data = gpt_model.state_dict()['ln_f.weight']
-    our_model.final_layer_norm.bias.data = gpt_model.state_dict()['ln_f.bias']
-
-    return our_model
+    our_model.final_layer_norm.weight.data = gpt_state_dict['ln_f.weight']
+    our_model.final_layer_norm.bias.data = gpt_state_dict['ln_f.bias']
+
+    # Contiguous copies (the transposes above are views) written atomically, so a concurrent reader
+    # never sees a partial file.
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    state_dict = {name: tensor.contiguous() for name, tensor in our_model.state_dict().items()}
+    tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+    torch.save(state_dict, tmp_filepath)
+    os.replace(tmp_filepath, filepath)
@@ -1,7 +1,51 @@
 import torch
+import torch.nn.functional as F
 
 from einops import rearrange
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+# reference: explicit softmax(QK^T)V, kept as the ground truth for the other backends.
+# sdpa: torch.nn.functional.scaled_dot_product_attention.
+# chunked: the reference math over blocks of queries, for long inputs.
+ATTENTION_BACKENDS = ('reference', 'sdpa', 'chunked')
+
+
+class PackedSequences:
+  """
+  Layout of a padding-free batch: the sequences are concatenated into one stream of total tokens and
+  cu_seqlens = [0, len_0, len_0 + len_1, ..., total] marks where each one starts.
+
+  Everything but attention (embeddings, norms, projections, MLP) runs on the stream as is, so no FLOPs
+  go to padding. Attention scatters each sequence's queries/keys/values into its own row of a
+  [num_seqs, max_len] block and gathers the context back, which is block-diagonal causal attention.
+  """
+
+  def __init__(self, cu_seqlens):
+    seq_lens = cu_seqlens[1:] - cu_seqlens[:-1]
+    device = cu_seqlens.device
+    self.cu_seqlens = cu_seqlens
+    self.num_seqs = seq_lens.numel()
+    self.max_len = int(seq_lens.max())
+    total = int(cu_seqlens[-1])
+    seq_ids = torch.repeat_interleave(torch.arange(self.num_seqs, device=device), seq_lens)
+    # Positions restart at 0 for every sequence: [total].
+    self.position_ids = torch.arange(total, device=device) - cu_seqlens[seq_ids]
+    # Slot of each packed token in the flattened [num_seqs * max_len] block.
+    self.index = seq_ids * self.max_len + self.position_ids
+    # [num_seqs, max_len], 1 for real tokens, as a padded attention_mask would be.
+    self.padding_mask = (torch.arange(self.max_len, device=device)[None, :] < seq_lens[:, None]).long()
+
+  def pad(self, x):
+    """[1, num_heads, total, head_size] -> [num_seqs, num_heads, max_len, head_size]"""
+    _, num_heads, _, head_size = x.shape
+    x = x[0].transpose(0, 1)
+    padded = x.new_zeros(self.num_seqs * self.max_len, num_heads, head_size).index_copy(0, self.index, x)
+    return padded.view(self.num_seqs, self.max_len, num_heads, head_size).transpose(1, 2)
+
+  def unpad(self, x):
+    """[num_seqs, max_len, hidden] -> [1, total, hidden]"""
+    return x.reshape(self.num_seqs * self.max_len, -1)[self.index].unsqueeze(0)
 
 
 class CausalSelfAttention(nn.Module):
@@ -12,15 +56,27 @@ class CausalSelfAttention(nn.Module):
     self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
     self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-    # Initialize the linear transformation layers for key, value, query.
-    self.query = nn.Linear(config.hidden_size, self.all_head_size)
-    self.key = nn.Linear(config.hidden_size, self.all_head_size)
-    self.value = nn.Linear(config.hidden_size, self.all_head_size)
+    # Initialize the linear transformation layers for key, value, query. In fused mode a single
+    # packed projection produces [query | key | value], the same layout as GPT-2's c_attn.
+    self.fused_qkv = config.fused_qkv
+    if self.fused_qkv:
+      self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
+    else:
+      self.query = nn.Linear(config.hidden_size, self.all_head_size)
+      self.key = nn.Linear(config.hidden_size, self.all_head_size)
+      self.value = nn.Linear(config.hidden_size, self.all_head_size)
+    # Checkpoints saved with either layout load into both.
+    self._register_load_state_dict_pre_hook(self._convert_qkv_state_dict)
     # This dropout is applied to normalized attention scores following the original
     # implementation of transformer. Although it is a bit unusual, we empirically
     # observe that it yields better performance.
     self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+    if config.attention_backend not in ATTENTION_BACKENDS:
+      raise ValueError(f'Unknown attention backend {config.attention_backend}, expected one of {ATTENTION_BACKENDS}.')
+    self.attention_backend = config.attention_backend
+    self.attention_chunk_size = config.attention_chunk_size
+
   def transform(self, x, linear_layer):
     # The corresponding linear_layer of k, v, q are used to project the hidden_state (x).
     proj = linear_layer(x)
@@ -31,41 +87,119 @@ class CausalSelfAttention(nn.Module):
     proj = rearrange(proj, 'b t h d -> b h t d')
     return proj
 
-  def attention(self, key, query, value, attention_mask):
+  def split_qkv(self, x):
+    # One GEMM for all three projections, then the heads are split out with views only:
+    # [bs, seq_len, 3 * hidden] -> 3 x [bs, num_attention_heads, seq_len, attention_head_size].
+    bs, seq_len, _ = x.shape
+    qkv = self.qkv(x).view(bs, seq_len, 3, self.num_attention_heads, self.attention_head_size)
+    return qkv.permute(2, 0, 3, 1, 4).unbind(0)
+
+  def _convert_qkv_state_dict(self, state_dict, prefix, *args):
+    """Repack query/key/value weights into qkv (or split qkv back up) to match this module's layout."""
+    split_names = ('query', 'key', 'value')
+    for param in ('weight', 'bias'):
+      split_keys = [f'{prefix}{name}.{param}' for name in split_names]
+      fused_key = f'{prefix}qkv.{param}'
+      if self.fused_qkv and all(key in state_dict for key in split_keys):
+        state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in split_keys], dim=0)
+      elif not self.fused_qkv and fused_key in state_dict:
+        for key, chunk in zip(split_keys, state_dict.pop(fused_key).chunk(3, dim=0)):
+          state_dict[key] = chunk
 
+  def reference_attention(self, key, query, value, attention_mask):
     # [bs, h, t_q, t_k]
     attention_scores = torch.matmul(query, key.transpose(-1, -2))
     attention_scores = attention_scores / (self.attention_head_size ** 0.5)
 
-    seq_len = query.size(-2)
-    causal_mask = torch.tril(
-      torch.ones((seq_len, seq_len), device=query.device, dtype=query.dtype)
-    ).view(1, 1, seq_len, seq_len)
-    causal_mask = (1.0 - causal_mask) * -10000.0
-
-    attention_scores = attention_scores + causal_mask + attention_mask
-    attention_probs = torch.softmax(attention_scores, dim=-1)
+    # attention_mask already combines causality and padding (True = may attend). The softmax runs in fp32
+    # even under bf16 autocast; the probabilities go back to the value dtype for the second matmul.
+    attention_scores = attention_scores.float()
+    attention_scores = torch.where(attention_mask, attention_scores, torch.finfo(attention_scores.dtype).min)
+    attention_probs = torch.softmax(attention_scores, dim=-1).to(value.dtype)
     attention_probs = self.dropout(attention_probs)
 
-    context = torch.matmul(attention_probs, value)
+    return torch.matmul(attention_probs, value)
+
+  def sdpa_attention(self, key, query, value, attention_mask):
+    # PyTorch's fused kernel takes the same boolean mask (True = may attend).
+    dropout_p = self.dropout.p if self.training else 0.0
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=dropout_p)
+
+  def chunked_attention(self, key, query, value, attention_mask):
+    """
+    Processes the queries in blocks of attention_chunk_size, so at most a [bs, h, chunk, t_k] score
+    tensor exists at once. When gradients are needed each block is checkpointed and its scores are
+    recomputed in backward, so the probabilities of the whole [t_q, t_k] matrix are never stored.
+    """
+    needs_grad = torch.is_grad_enabled() and any(t.requires_grad for t in (key, query, value))
+    context = []
+    for start in range(0, query.size(-2), self.attention_chunk_size):
+      end = start + self.attention_chunk_size
+      query_chunk, mask_chunk = query[:, :, start:end], attention_mask[:, :, start:end]
+      if needs_grad:
+        context.append(checkpoint(self.reference_attention, key, query_chunk, value, mask_chunk,
+                                  use_reentrant=False))
+      else:
+        context.append(self.reference_attention(key, query_chunk, value, mask_chunk))
+    return torch.cat(context, dim=-2)
+
+  def attention(self, key, query, value, attention_mask):
+    if self.attention_backend == 'sdpa':
+      context = self.sdpa_attention(key, query, value, attention_mask)
+    elif self.attention_backend == 'chunked':
+      context = self.chunked_attention(key, query, value, attention_mask)
+    else:
+      context = self.reference_attention(key, query, value, attention_mask)
+
     # [bs, seq_len, hidden]
     context = rearrange(context, 'b h t d -> b t (h d)')
     return context
 
 
-  def forward(self, hidden_states, attention_mask):
+  def forward(self, hidden_states, attention_mask, layer_past=None, use_cache=False, packed=None, query_positions=None):
     """
     hidden_states: [bs, seq_len, hidden_state]
-    attention_mask: [bs, 1, 1, seq_len]
-    output: [bs, seq_len, hidden_state]
+    attention_mask: boolean [bs, 1, seq_len, past_len + seq_len], True where a query may attend to a key
+    layer_past: optional (key, value) from earlier decoding steps, each [bs, num_attention_heads, past_len, attention_head_size]
+    use_cache: if True, also return the (key, value) covering past and current tokens.
+    packed: optional PackedSequences; hidden_states is then the packed stream [1, total, hidden_state]
+      and attention_mask is [num_seqs, 1, max_len, max_len].
+    query_positions: optional [bs, num_positions] indices into seq_len. Only these positions are queried
+      (keys and values still cover every position) and attention_mask holds just their rows. With packed,
+      [1, num_seqs] stream indices with one query per sequence.
+    output: ([bs, seq_len, hidden_state], present), present is None unless use_cache is set;
+      [bs, num_positions, hidden_state] with query_positions
     """
     # First, we have to generate the key, value, query for each token for multi-head attention
     # using self.transform (more details inside the function).
     # Size of *_layer is [bs, num_attention_heads, seq_len, attention_head_size].
-    key_layer = self.transform(hidden_states, self.key)
-    value_layer = self.transform(hidden_states, self.value)
-    query_layer = self.transform(hidden_states, self.query)
-    
+    if self.fused_qkv:
+      # The fused projection produces every query; the unused ones are dropped right away.
+      query_layer, key_layer, value_layer = self.split_qkv(hidden_states)
+      if query_positions is not None:
+        query_layer = torch.take_along_dim(query_layer, query_positions[:, None, :, None], dim=2)
+    else:
+      key_layer = self.transform(hidden_states, self.key)
+      value_layer = self.transform(hidden_states, self.value)
+      if query_positions is not None:
+        hidden_states = torch.take_along_dim(hidden_states, query_positions[..., None], dim=1)
+      query_layer = self.transform(hidden_states, self.query)
+
+    # Prepend the cached keys and values so the new queries attend to the whole prefix.
+    if layer_past is not None:
+      past_key, past_value = layer_past
+      key_layer = torch.cat([past_key, key_layer], dim=-2)
+      value_layer = torch.cat([past_value, value_layer], dim=-2)
+    present = (key_layer, value_layer) if use_cache else None
+
     # Calculate the multi-head attention.
+    if packed is not None:
+      key_layer, value_layer = packed.pad(key_layer), packed.pad(value_layer)
+      if query_positions is not None:
+        # One query per sequence: [1, h, num_seqs, d] -> [num_seqs, h, 1, d],
+        # and the context back from [num_seqs, 1, hidden] to [1, num_seqs, hidden].
+        attn_value = self.attention(key_layer, query_layer.transpose(0, 2), value_layer, attention_mask)
+        return attn_value.transpose(0, 1), present
+      return packed.unpad(self.attention(key_layer, packed.pad(query_layer), value_layer, attention_mask)), present
     attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
-    return attn_value
+    return attn_value, present
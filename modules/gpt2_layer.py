@@ -1,8 +1,10 @@
+import torch
 from torch import nn
 
 import torch.nn.functional as F
 
 from modules.attention import CausalSelfAttention
+from modules.layer_norm import LayerNorm
 
 class GPT2Layer(nn.Module):
   def __init__(self, config):
@@ -11,14 +13,14 @@ class GPT2Layer(nn.Module):
     self.self_attention = CausalSelfAttention(config)
     # Add-norm for multi-head attention.
     self.attention_dense = nn.Linear(config.hidden_size, config.hidden_size)
-    self.attention_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+    self.attention_layer_norm = LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
     self.attention_dropout = nn.Dropout(config.hidden_dropout_prob)
     # Feed forward.
     self.interm_dense = nn.Linear(config.hidden_size, config.intermediate_size)
     self.interm_af = F.gelu
     # Add-norm for feed forward.
     self.out_dense = nn.Linear(config.intermediate_size, config.hidden_size)
-    self.out_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
+    self.out_layer_norm = LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
     self.out_dropout = nn.Dropout(config.hidden_dropout_prob)
 
   def add(self, input, output, dense_layer, dropout):
@@ -34,22 +36,35 @@ class GPT2Layer(nn.Module):
     return input + transformed
 
 
-  def forward(self, hidden_states, attention_mask):
+  def forward(self, hidden_states, attention_mask, layer_past=None, use_cache=False, packed=None,
+              output_positions=None):
     """
     TODO: Implement the forward pass. Some key points to consider:
            - A multi-head attention layer (CausalSelfAttention) that computes self-attention based on masked inputs.
            - Layer normalization applied *before* the attention layer and feed-forward layer.
            - Apply dropout, residual connection, and layer normalization according to the plot in the assignment. (Use self.add)
            - A feed-forward layer that applies transformations to further refine the hidden states.
+
+    layer_past / use_cache are passed through to the attention layer; the returned present holds this
+    layer's (key, value) for incremental decoding, or None if use_cache is False. packed (a
+    PackedSequences) marks hidden_states as a padding-free stream of several sequences.
+
+    With output_positions ([bs, num_positions] indices into seq_len) only those positions continue past the
+    attention keys/values: the queries, residuals and MLP run on [bs, num_positions, hidden_size], and
+    attention_mask holds just their rows.
     """
 
     normed_hidden_states = self.attention_layer_norm(hidden_states)
-    attention_output = self.self_attention(normed_hidden_states, attention_mask)
+    attention_output, present = self.self_attention(normed_hidden_states, attention_mask,
+                                                    layer_past=layer_past, use_cache=use_cache, packed=packed,
+                                                    query_positions=output_positions)
+    if output_positions is not None:
+      hidden_states = torch.take_along_dim(hidden_states, output_positions[..., None], dim=1)
     hidden_states = self.add(hidden_states, attention_output, self.attention_dense, self.attention_dropout)
 
     normed_hidden_states = self.out_layer_norm(hidden_states)
     interm_output = self.interm_af(self.interm_dense(normed_hidden_states))
     hidden_states = self.add(hidden_states, interm_output, self.out_dense, self.out_dropout)
 
-    return hidden_states
+    return hidden_states, present
 
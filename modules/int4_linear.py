@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+
+from torch import nn
+
+
+class Int4Linear(nn.Module):
+  """
+  Inference-only linear layer with group-wise 4-bit weights.
+
+  Each weight row is split into groups of group_size inputs. A group stores an fp16 scale and minimum,
+  and its values as codes in [0, 15] with w ~= code * scale + minimum, two codes packed per byte. The
+  weight is dequantized to the input dtype on the fly for every matmul, so only the packed form stays resident.
+  """
+
+  def __init__(self, in_features, out_features, bias=True, group_size=64, device=None):
+    super().__init__()
+    if in_features % group_size or group_size % 2:
+      raise ValueError(f'in_features={in_features} must be a multiple of the (even) group size {group_size}.')
+    self.in_features = in_features
+    self.out_features = out_features
+    self.group_size = group_size
+    num_groups = in_features // group_size
+    self.register_buffer('qweight', torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device))
+    self.register_buffer('scales', torch.empty(out_features, num_groups, dtype=torch.float16, device=device))
+    self.register_buffer('mins', torch.empty(out_features, num_groups, dtype=torch.float16, device=device))
+    if bias:
+      self.register_buffer('bias', torch.empty(out_features, dtype=torch.float16, device=device))
+    else:
+      self.bias = None
+
+  @classmethod
+  @torch.no_grad()
+  def from_linear(cls, linear, group_size=64):
+    """Quantizes an nn.Linear (asymmetric min/max per group)."""
+    module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, group_size=group_size,
+                 device=linear.weight.device)
+    groups = linear.weight.float().view(linear.out_features, -1, group_size)
+    mins = groups.amin(dim=-1).half()
+    scales = ((groups.amax(dim=-1) - groups.amin(dim=-1)) / 15).clamp(min=1e-6).half()
+    # Round with the fp16 scale and minimum that are stored, so dequantization reproduces the codes exactly.
+    codes = torch.round((groups - mins.float()[..., None]) / scales.float()[..., None]).clamp(0, 15).to(torch.uint8)
+    codes = codes.view(linear.out_features, linear.in_features)
+    module.qweight.copy_(codes[:, 0::2] | (codes[:, 1::2] << 4))
+    module.scales.copy_(scales)
+    module.mins.copy_(mins)
+    if linear.bias is not None:
+      module.bias.copy_(linear.bias)
+    return module
+
+  def dequantize(self, dtype=torch.float32):
+    # Unpack the low and high nibbles back into interleaved [out_features, in_features] codes.
+    codes = torch.stack([self.qweight & 0x0F, self.qweight >> 4], dim=-1).view(self.out_features, -1, self.group_size)
+    weight = codes.to(dtype) * self.scales[..., None].to(dtype) + self.mins[..., None].to(dtype)
+    return weight.view(self.out_features, self.in_features)
+
+  def forward(self, input):
+    bias = self.bias.to(input.dtype) if self.bias is not None else None
+    return F.linear(input, self.dequantize(input.dtype), bias)
+
+  def extra_repr(self):
+    return f'in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}'
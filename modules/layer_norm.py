@@ -0,0 +1,13 @@
+import torch
+import torch.nn.functional as F
+
+from torch import nn
+
+
+class LayerNorm(nn.LayerNorm):
+  """nn.LayerNorm that always normalizes in fp32, also under bf16 autocast or with bf16 weights."""
+
+  def forward(self, input):
+    with torch.autocast(device_type=input.device.type, enabled=False):
+      output = F.layer_norm(input.float(), self.normalized_shape, self.weight.float(), self.bias.float(), self.eps)
+    return output.to(input.dtype)
@@ -1,9 +1,48 @@
+from functools import lru_cache
 from typing import Callable, Iterable, Tuple
 import math
 
 import torch
+import torch.nn.functional as F
 from torch.optim import Optimizer
 
+QUANTIZATION_BLOCK_SIZE = 2048
+
+
+@lru_cache(maxsize=None)
+def quantization_map(signed: bool, device: torch.device = torch.device("cpu")) -> torch.Tensor:
+    """
+    The levels of the 8-bit code for optimizer states, in increasing order on [-1, 1] (signed) or [0, 1]: zero and
+    levels spaced geometrically from 1e-7 up to 1, so small values keep a few percent of relative precision instead
+    of rounding to zero as with evenly spaced levels.
+    """
+    if signed:
+        levels = torch.logspace(-7, 0, 127, dtype=torch.float64)
+        levels = torch.cat([-levels.flip(0), torch.zeros(1, dtype=torch.float64), levels])
+    else:
+        levels = torch.cat([torch.zeros(1, dtype=torch.float64), torch.logspace(-7, 0, 255, dtype=torch.float64)])
+    return levels.float().to(device)
+
+
+def quantize_blockwise(x: torch.Tensor, signed: bool, block_size: int = QUANTIZATION_BLOCK_SIZE):
+    """
+    Splits x into blocks of block_size values, each scaled by its absolute maximum (kept in fp32) and rounded to the
+    nearest level of quantization_map. Returns the uint8 codes [num_blocks, block_size] and the scales [num_blocks].
+    """
+    levels = quantization_map(signed, x.device)
+    flat = x.reshape(-1).float()
+    blocks = F.pad(flat, (0, -flat.numel() % block_size)).view(-1, block_size)
+    absmax = blocks.abs().amax(dim=1).clamp(min=1e-30)
+    codes = torch.bucketize(blocks / absmax[:, None], (levels[1:] + levels[:-1]) / 2)
+    return codes.to(torch.uint8), absmax
+
+
+def dequantize_blockwise(codes: torch.Tensor, absmax: torch.Tensor, signed: bool, shape: torch.Size) -> torch.Tensor:
+    """The fp32 tensor of the given shape that quantize_blockwise encoded as codes and absmax."""
+    levels = quantization_map(signed, codes.device)
+    values = levels[codes.long()] * absmax[:, None]
+    return values.view(-1)[:math.prod(shape)].view(shape)
+
 
 class AdamW(Optimizer):
     def __init__(
@@ -14,6 +53,10 @@ class AdamW(Optimizer):
             eps: float = 1e-6,
             weight_decay: float = 0.0,
             correct_bias: bool = True,
+            master_weights: bool = False,
+            foreach: bool = False,
+            flat: bool = False,
+            state_format: str = "fp32",
     ):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
@@ -23,15 +66,120 @@ class AdamW(Optimizer):
             raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+        if state_format not in ("fp32", "int8", "factored"):
+            raise ValueError("Invalid state format: {} - should be fp32, int8 or factored".format(state_format))
+        if flat and state_format != "fp32":
+            raise ValueError("Flat buffers keep the optimizer state in fp32, not {}".format(state_format))
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias,
+                        master_weights=master_weights, foreach=foreach, flat=flat,
+                        state_format=state_format)
         super().__init__(params, defaults)
+        self._flat_buffers = []
+        for index, group in enumerate(self.param_groups):
+            if group["flat"]:
+                self._flatten_group(index, group)
+
+    def _flatten_group(self, index, group):
+        """
+        Moves the trainable parameters of a group into one contiguous buffer per (device, dtype), with gradient,
+        moment (and master weight) buffers to match. The parameters and their .grad become views into these
+        buffers, so the state of every parameter is updated by a single set of kernels in _flat_step, and saving
+        the state writes one large tensor per buffer.
+
+        Gradients must then be cleared with zero_grad() of this optimizer, which zeroes the buffers in place, and
+        the model must not be moved or cast afterwards. Every parameter takes part in every step: one that got no
+        gradient is updated with a zero gradient instead of being skipped.
+        """
+        params_by_type = {}
+        for p in group["params"]:
+            if p.requires_grad:
+                params_by_type.setdefault((p.device, p.dtype), []).append(p)
+
+        for (device, dtype), params in params_by_type.items():
+            offsets = [0]
+            for p in params:
+                offsets.append(offsets[-1] + p.numel())
+            flat_param = torch.empty(offsets[-1], device=device, dtype=dtype)
+            flat_grad = torch.zeros_like(flat_param)
+            buffer = dict(group=index, params=params, offsets=offsets[:-1], step=0, param=flat_param, grad=flat_grad)
+            for p, param, grad in zip(params, self._views(buffer, flat_param), self._views(buffer, flat_grad)):
+                param.copy_(p.data)
+                p.data = param
+                p.grad = grad
+
+            use_master = group["master_weights"] and dtype != torch.float32
+            buffer["master_param"] = flat_param.float() if use_master else None
+            update = buffer["master_param"] if use_master else flat_param
+            buffer["exp_avg"] = torch.zeros_like(update)
+            buffer["exp_avg_sq"] = torch.zeros_like(update)
+            self._flat_buffers.append(buffer)
+            self._link_flat_state(buffer)
+
+    @staticmethod
+    def _views(buffer, flat):
+        return [flat[offset:offset + p.numel()].view(p.shape) for p, offset in zip(buffer["params"], buffer["offsets"])]
+
+    def _flat_state_keys(self, buffer):
+        return ("exp_avg", "exp_avg_sq") + (("master_param",) if buffer["master_param"] is not None else ())
+
+    def _link_flat_state(self, buffer):
+        # The per-parameter state holds views into the flat buffers, so state_dict() sees the usual layout.
+        for key in self._flat_state_keys(buffer):
+            for p, view in zip(buffer["params"], self._views(buffer, buffer[key])):
+                self.state[p][key] = view
+        for p in buffer["params"]:
+            self.state[p]["step"] = buffer["step"]
+
+    def zero_grad(self, set_to_none: bool = True):
+        if not self._flat_buffers:
+            return super().zero_grad(set_to_none)
+        # The gradients of flat groups are views into a buffer, which must stay in place.
+        for buffer in self._flat_buffers:
+            buffer["grad"].zero_()
+        for group in self.param_groups:
+            if not group["flat"]:
+                for p in group["params"]:
+                    p.grad = None
+
+    def load_state_dict(self, state_dict):
+        # Optimizer.load_state_dict casts the state to each parameter's dtype, which would round the fp32
+        # master weights, moments and quantization scales of bf16 parameters and turn the uint8 codes of int8
+        # states into floats; put every saved tensor back in its saved dtype.
+        super().load_state_dict(state_dict)
+        for saved_group, group in zip(state_dict["param_groups"], self.param_groups):
+            for index, p in zip(saved_group["params"], group["params"]):
+                saved_state = state_dict["state"].get(index, {})
+                for key, value in saved_state.items():
+                    if torch.is_tensor(value):
+                        self.state[p][key] = value.to(device=p.device)
+        # Copy the loaded state of flat groups into their buffers, and point the state at the buffers again.
+        for buffer in self._flat_buffers:
+            for key in self._flat_state_keys(buffer):
+                for p, view in zip(buffer["params"], self._views(buffer, buffer[key])):
+                    view.copy_(self.state[p][key])
+            buffer["step"] = self.state[buffer["params"][0]].get("step", 0)
+            self._link_flat_state(buffer)
 
     def step(self, closure: Callable = None):
         loss = None
         if closure is not None:
             loss = closure()
 
+        for buffer in self._flat_buffers:
+            self._flat_step(buffer)
+
         for group in self.param_groups:
+            if group.get("flat", False):
+                continue
+            if group.get("state_format", "fp32") == "int8":
+                self._quantized_step(group)
+                continue
+            if group.get("state_format", "fp32") == "factored":
+                self._factored_step(group)
+                continue
+            if group.get("foreach", False):
+                self._foreach_step(group)
+                continue
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -60,33 +208,233 @@ class AdamW(Optimizer):
                 ###       4. Apply weight decay after the main gradient-based updates.
                 ###
                 ###       Refer to the default project handout for more details.
+                # With master_weights, low-precision (e.g. bf16) parameters are updated through an fp32 copy
+                # that lives in the state, and the result is rounded back into the parameter.
+                use_master = group.get("master_weights", False) and p.dtype != torch.float32
                 if len(state) == 0:
                     state["step"] = 0
-                    state["exp_avg"] = torch.zeros_like(p.data)
-                    state["exp_avg_sq"] = torch.zeros_like(p.data)
+                    if use_master:
+                        state["master_param"] = p.data.float()
+                    param = state["master_param"] if use_master else p.data
+                    state["exp_avg"] = torch.zeros_like(param)
+                    state["exp_avg_sq"] = torch.zeros_like(param)
 
-                beta1, beta2 = group["betas"]
-                eps = group["eps"]
-                weight_decay = group["weight_decay"]
-                correct_bias = group["correct_bias"]
+                param = state["master_param"] if use_master else p.data
+                if use_master:
+                    grad = grad.float()
 
                 state["step"] += 1
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+                self._adam_update(group, param, grad, state["exp_avg"], state["exp_avg_sq"], state["step"])
+
+                if use_master:
+                    p.data.copy_(param)
+
+
+        return loss
+
+    @torch.no_grad()
+    def _foreach_step(self, group):
+        """
+        The same update as the loop in step(), for a whole param group at once: the tensors are grouped by device
+        and dtype, and each group takes one torch._foreach_* kernel launch per operation instead of one per tensor.
+        """
+        alpha = group["lr"]
+        beta1, beta2 = group["betas"]
+        eps = group["eps"]
+        weight_decay = group["weight_decay"]
+        correct_bias = group["correct_bias"]
 
-                exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+        tensor_groups = {}
+        masters = []
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            grad = p.grad
+            if grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
 
-                denom = exp_avg_sq.sqrt().add_(eps)
+            state = self.state[p]
+            use_master = group.get("master_weights", False) and p.dtype != torch.float32
+            if len(state) == 0:
+                state["step"] = 0
+                if use_master:
+                    state["master_param"] = p.float()
+                param = state["master_param"] if use_master else p
+                state["exp_avg"] = torch.zeros_like(param)
+                state["exp_avg_sq"] = torch.zeros_like(param)
+
+            param = state["master_param"] if use_master else p
+            if use_master:
+                grad = grad.float()
+                masters.append((p, param))
+            state["step"] += 1
+
+            params, grads, exp_avgs, exp_avg_sqs, steps = tensor_groups.setdefault(
+                (param.device, param.dtype), ([], [], [], [], []))
+            params.append(param)
+            grads.append(grad)
+            exp_avgs.append(state["exp_avg"])
+            exp_avg_sqs.append(state["exp_avg_sq"])
+            steps.append(state["step"])
+
+        for params, grads, exp_avgs, exp_avg_sqs, steps in tensor_groups.values():
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denoms, eps)
+            # Parameters may have taken different numbers of steps, so the bias corrections are per tensor.
+            step_sizes = []
+            for step in steps:
                 step_size = alpha
                 if correct_bias:
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+                    step_size = step_size * math.sqrt(1.0 - beta2 ** step) / (1.0 - beta1 ** step)
+                step_sizes.append(-step_size)
+            torch._foreach_addcdiv_(params, exp_avgs, denoms, step_sizes)
 
-                p.data.addcdiv_(exp_avg, denom, value=-step_size)
+            if weight_decay > 0.0:
+                torch._foreach_add_(params, params, alpha=-alpha * weight_decay)
 
-                if weight_decay > 0.0:
-                    p.data.add_(p.data, alpha=-alpha * weight_decay)
+        for p, master_param in masters:
+            p.copy_(master_param)
 
+    @torch.no_grad()
+    def _flat_step(self, buffer):
+        """The update of step() for a whole flat buffer (see _flatten_group) at once."""
+        group = self.param_groups[buffer["group"]]
+        use_master = buffer["master_param"] is not None
+        param = buffer["master_param"] if use_master else buffer["param"]
+        grad = buffer["grad"].float() if use_master else buffer["grad"]
+        buffer["step"] += 1
+        self._adam_update(group, param, grad, buffer["exp_avg"], buffer["exp_avg_sq"], buffer["step"])
 
-        return loss
+        if use_master:
+            buffer["param"].copy_(param)
+        for p in buffer["params"]:
+            self.state[p]["step"] = buffer["step"]
+
+    @torch.no_grad()
+    def _quantized_step(self, group):
+        """
+        The update of step() with both moments stored 8-bit between steps (see quantize_blockwise): a byte per
+        value plus an fp32 scale per block, instead of 4 bytes per value. Each parameter's moments are
+        dequantized to fp32 for its update and quantized again afterwards.
+        """
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            grad = p.grad
+            if grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+
+            state = self.state[p]
+            use_master = group.get("master_weights", False) and p.dtype != torch.float32
+            if len(state) == 0:
+                state["step"] = 0
+                if use_master:
+                    state["master_param"] = p.float()
+                zeros = torch.zeros(p.shape, device=p.device)
+                state["exp_avg_codes"], state["exp_avg_absmax"] = quantize_blockwise(zeros, signed=True)
+                state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"] = quantize_blockwise(zeros, signed=False)
+
+            param = state["master_param"] if use_master else p
+            grad = grad.float()
+            exp_avg = dequantize_blockwise(state["exp_avg_codes"], state["exp_avg_absmax"], True, p.shape)
+            exp_avg_sq = dequantize_blockwise(state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"], False, p.shape)
+            state["step"] += 1
+            self._adam_update(group, param, grad, exp_avg, exp_avg_sq, state["step"])
+
+            state["exp_avg_codes"], state["exp_avg_absmax"] = quantize_blockwise(exp_avg, signed=True)
+            state["exp_avg_sq_codes"], state["exp_avg_sq_absmax"] = quantize_blockwise(exp_avg_sq, signed=False)
+            if use_master:
+                p.copy_(param)
+
+    @staticmethod
+    def _adam_update(group, param, grad, exp_avg, exp_avg_sq, step):
+        """
+        The AdamW update, in place on param (a parameter, master weight or flat buffer) and its two moments. Every
+        state format except foreach goes through here.
+        """
+        alpha = group["lr"]
+        beta1, beta2 = group["betas"]
+
+        exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+
+        denom = exp_avg_sq.sqrt().add_(group["eps"])
+        step_size = alpha
+        if group["correct_bias"]:
+            bias_correction1 = 1.0 - beta1 ** step
+            bias_correction2 = 1.0 - beta2 ** step
+            step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+
+        param.addcdiv_(exp_avg, denom, value=-step_size)
+
+        if group["weight_decay"] > 0.0:
+            param.add_(param, alpha=-alpha * group["weight_decay"])
+
+    @torch.no_grad()
+    def _factored_step(self, group, clip_threshold=1.0):
+        """
+        A memory-light variant of step() after Adafactor (https://arxiv.org/abs/1804.04235). For a parameter of two
+        or more dimensions, viewed as a [rows, cols] matrix, the second moment is kept as running means of the
+        squared gradient over each row and each column, and estimated as their outer product divided by the
+        mean of the row statistics. Such parameters keep no first moment, so their update is the gradient over the
+        root of that estimate, scaled down when its RMS exceeds clip_threshold. That stores rows + cols values
+        instead of 2 * rows * cols. Biases and LayerNorm weights (1-D) take the regular AdamW update.
+        """
+        alpha = group["lr"]
+        _, beta2 = group["betas"]
+
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            grad = p.grad
+            if grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+
+            state = self.state[p]
+            use_master = group.get("master_weights", False) and p.dtype != torch.float32
+            factored = p.dim() >= 2
+            if len(state) == 0:
+                state["step"] = 0
+                if use_master:
+                    state["master_param"] = p.float()
+                if factored:
+                    rows = p.numel() // p.shape[-1]
+                    state["exp_avg_sq_row"] = torch.zeros(rows, device=p.device)
+                    state["exp_avg_sq_col"] = torch.zeros(p.shape[-1], device=p.device)
+                else:
+                    state["exp_avg"] = torch.zeros(p.shape, device=p.device)
+                    state["exp_avg_sq"] = torch.zeros(p.shape, device=p.device)
+
+            param = state["master_param"] if use_master else p
+            grad = grad.float()
+            state["step"] += 1
+            if not factored:
+                self._adam_update(group, param, grad, state["exp_avg"], state["exp_avg_sq"], state["step"])
+                if use_master:
+                    p.copy_(param)
+                continue
+
+            matrix = grad.reshape(-1, grad.shape[-1])
+            squared = matrix.square().add_(1e-30)
+            row, col = state["exp_avg_sq_row"], state["exp_avg_sq_col"]
+            row.mul_(beta2).add_(squared.mean(dim=1), alpha=1.0 - beta2)
+            col.mul_(beta2).add_(squared.mean(dim=0), alpha=1.0 - beta2)
+
+            exp_avg_sq = torch.outer(row / row.mean(), col)
+            if group["correct_bias"]:
+                exp_avg_sq.div_(1.0 - beta2 ** state["step"])
+            update = matrix / exp_avg_sq.sqrt().add_(group["eps"])
+            update.div_((update.square().mean().sqrt() / clip_threshold).clamp(min=1.0))
+
+            param.add_(update.view(param.shape), alpha=-alpha)
+
+            if group["weight_decay"] > 0.0:
+                param.add_(param, alpha=-alpha * group["weight_decay"])
+
+            if use_master:
+                p.copy_(param)
@@ -1,6 +1,10 @@
+import math
+import time
+from functools import partial
+
 import torch
 import numpy as np
-from optimizer import AdamW
+from optimizer import AdamW, dequantize_blockwise, quantize_blockwise
 
 SEED = 0
 
@@ -25,10 +29,174 @@ def test_optimizer(opt_class) -> torch.Tensor:
         opt.step()
     return model.weight.detach()
 
+
+def gpt2_shaped_params(num_layers, hidden_size=64, vocab_size=1000):
+    """Parameters with GPT-2's tensor count for num_layers (the step overhead), at a small width."""
+    from config import GPT2Config
+    from models.gpt2 import GPT2Model
+    config = GPT2Config(vocab_size=vocab_size, hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=4, intermediate_size=4 * hidden_size, max_position_embeddings=128)
+    return list(GPT2Model(config).parameters())
+
+
+def test_foreach():
+    # Several shapes, a parameter without a gradient, and bf16 parameters with fp32 master weights.
+    torch.manual_seed(SEED)
+    for dtype, master_weights in ((torch.float32, False), (torch.bfloat16, True)):
+        params = [torch.randn(shape).to(dtype) for shape in ((4, 3), (3,), (5, 2, 2), (2,))]
+        results = []
+        for foreach in (False, True):
+            copies = [torch.nn.Parameter(p.clone()) for p in params]
+            opt = AdamW(copies, lr=1e-2, weight_decay=1e-2, master_weights=master_weights, foreach=foreach)
+            generator = torch.Generator().manual_seed(SEED)
+            for _ in range(20):
+                for p in copies[:-1]:
+                    p.grad = torch.randn(p.shape, generator=generator).to(dtype)
+                opt.step()
+            results.append(copies)
+        # Identical arithmetic; at most a rounding difference flips a bf16 value by one ulp.
+        rtol = 1e-5 if dtype == torch.float32 else 1e-2
+        for expected, actual in zip(*results):
+            assert torch.allclose(expected.float(), actual.float(), atol=1e-6, rtol=rtol)
+
+
+def test_flat():
+    torch.manual_seed(SEED)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.LayerNorm(3))
+    opt = AdamW(model.parameters(), lr=1e-2, weight_decay=1e-2, flat=True)
+    flat_param = opt._flat_buffers[0]["param"]
+    assert all(p.untyped_storage().data_ptr() == flat_param.untyped_storage().data_ptr() for p in model.parameters())
+
+    x = torch.randn(8, 4)
+    for _ in range(5):
+        opt.zero_grad()
+        model(x).pow(2).sum().backward()
+        opt.step()
+
+    # A reloaded state continues exactly like the original.
+    reloaded = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.LayerNorm(3))
+    reloaded.load_state_dict(model.state_dict())
+    reloaded_opt = AdamW(reloaded.parameters(), lr=1e-2, weight_decay=1e-2, flat=True)
+    reloaded_opt.load_state_dict(opt.state_dict())
+    for m, o in ((model, opt), (reloaded, reloaded_opt)):
+        o.zero_grad()
+        m(x).pow(2).sum().backward()
+        o.step()
+    for p, q in zip(model.parameters(), reloaded.parameters()):
+        assert torch.equal(p, q)
+
+
+def test_quantize_blockwise():
+    torch.manual_seed(SEED)
+    # Values spanning several orders of magnitude within each block, like Adam's moments.
+    x = torch.randn(4, 1500) * torch.logspace(-4, 0, 1500)
+    for signed, values in ((True, x), (False, x.abs())):
+        codes, absmax = quantize_blockwise(values, signed)
+        assert codes.dtype == torch.uint8 and absmax.shape == (3,)
+        restored = dequantize_blockwise(codes, absmax, signed, values.shape)
+        assert torch.all((restored - values).abs() <= 0.07 * values.abs() + 1e-7 * absmax.max())
+
+    # A byte per value plus a scale per block: about a quarter of fp32.
+    codes, absmax = quantize_blockwise(torch.randn(8192), signed=True)
+    assert codes.numel() + 4 * absmax.numel() < 8192 * 4 / 3.9
+
+
+def test_int8_state():
+    # Converges like the fp32 states on a small regression problem.
+    torch.manual_seed(SEED)
+    x, w = torch.randn(256, 16), torch.randn(16, 4)
+    y = x @ w
+    losses = {}
+    for state_format in ('fp32', 'int8'):
+        torch.manual_seed(SEED)
+        model = torch.nn.Linear(16, 4)
+        opt = AdamW(model.parameters(), lr=1e-2, state_format=state_format)
+        for _ in range(300):
+            opt.zero_grad()
+            loss = ((model(x) - y) ** 2).mean()
+            loss.backward()
+            opt.step()
+        losses[state_format] = loss.item()
+    assert losses['int8'] < 1e-2 and abs(losses['int8'] - losses['fp32']) < 0.1 * losses['fp32'] + 1e-4
+
+    # The state round-trips through state_dict.
+    reloaded = AdamW(model.parameters(), lr=1e-2, state_format='int8')
+    reloaded.load_state_dict(opt.state_dict())
+    for p in model.parameters():
+        for key, value in opt.state[p].items():
+            assert torch.equal(torch.as_tensor(value), torch.as_tensor(reloaded.state[p][key]))
+            if torch.is_tensor(value):
+                assert reloaded.state[p][key].dtype == value.dtype, key
+
+
+def test_factored_state():
+    torch.manual_seed(SEED)
+    x, w = torch.randn(256, 16), torch.randn(16, 4)
+    y = x @ w
+    model = torch.nn.Linear(16, 4)
+    opt = AdamW(model.parameters(), lr=1e-2, state_format='factored')
+    for _ in range(300):
+        opt.zero_grad()
+        loss = ((model(x) - y) ** 2).mean()
+        loss.backward()
+        opt.step()
+    assert loss.item() < 1e-2
+
+    # Row and column statistics for the matrix, full moments for the bias.
+    assert {k: tuple(v.shape) for k, v in opt.state[model.weight].items() if torch.is_tensor(v)} == \
+           {'exp_avg_sq_row': (4,), 'exp_avg_sq_col': (16,)}
+    assert set(opt.state[model.bias]) == {'step', 'exp_avg', 'exp_avg_sq'}
+    assert state_megabytes(gpt2_xl_shapes(), 'factored') < state_megabytes(gpt2_xl_shapes(), 'fp32') / 500
+
+
+def gpt2_xl_shapes(num_layers=48, d=1600, vocab_size=50257, max_positions=1024):
+    """Parameter shapes of gpt2-xl, to size its optimizer state without allocating it."""
+    layer = [(d, d), (d,)] * 4 + [(d,), (d,)] * 2 + [(4 * d, d), (4 * d,), (d, 4 * d), (d,)]
+    return [(vocab_size, d), (max_positions, d)] + layer * num_layers + [(d,), (d,)]
+
+
+def state_megabytes(shapes, state_format):
+    """fp32 optimizer state size of parameters with the given shapes, in MB."""
+    numel = 0
+    for shape in shapes:
+        if state_format == 'factored' and len(shape) >= 2:
+            numel += math.prod(shape[:-1]) + shape[-1]
+        else:
+            numel += 2 * math.prod(shape)
+    return numel * 4 / 2 ** 20
+
+
+def benchmark(steps=20):
+    """Step time of the per-tensor loop vs. foreach vs. flat buffers, with the tensor counts of each GPT-2 size."""
+    for model_size, num_layers in (('gpt2', 12), ('gpt2-medium', 24), ('gpt2-large', 36), ('gpt2-xl', 48)):
+        params = gpt2_shaped_params(num_layers)
+        for p in params:
+            p.grad = torch.randn_like(p)
+        times = {}
+        for mode in ('loop', 'foreach', 'flat'):
+            opt = AdamW(params, lr=1e-3, weight_decay=1e-2, foreach=mode == 'foreach', flat=mode == 'flat')
+            opt.step()  # warm up, and initialise the state
+            start = time.perf_counter()
+            for _ in range(steps):
+                opt.step()
+            times[mode] = (time.perf_counter() - start) / steps * 1000
+        print(f"{model_size} ({len(params)} tensors) :: " +
+              ", ".join(f"{mode} {ms :.2f}ms/step ({times['loop'] / ms :.1f}x)" for mode, ms in times.items()))
+
+
 if __name__ == '__main__':
     ref = torch.tensor(np.load("optimizer_test.npy"))
-    actual = test_optimizer(AdamW)
-    print(ref)
-    print(actual)
-    assert torch.allclose(ref, actual, atol=1e-6, rtol=1e-4)
+    for opt_class in (AdamW, partial(AdamW, foreach=True), partial(AdamW, flat=True)):
+        actual = test_optimizer(opt_class)
+        print(ref)
+        print(actual)
+        assert torch.allclose(ref, actual, atol=1e-6, rtol=1e-4)
+    test_foreach()
+    test_flat()
+    test_quantize_blockwise()
+    test_int8_state()
+    test_factored_state()
     print("Optimizer test passed!")
+    benchmark()
+    print(f"gpt2-xl optimizer state :: fp32 {state_megabytes(gpt2_xl_shapes(), 'fp32') :.0f}MB, "
+          f"factored {state_megabytes(gpt2_xl_shapes(), 'factored') :.1f}MB")
@@ -13,7 +13,6 @@ import numpy as np
 import torch.nn.functional as F
 
 from torch import nn
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from datasets import (
@@ -25,6 +24,9 @@ from evaluation import model_eval_paraphrase, model_test_paraphrase
 from models.gpt2 import GPT2Model
 
 from optimizer import AdamW
+from samplers import length_grouped_dataloader
+from utils import (add_efficiency_arguments, autocast_context, batch_cu_seqlens, gpt_config_kwargs,
+                   load_task_checkpoint, parse_gradient_checkpointing)
 
 TQDM_DISABLE = False
 
@@ -42,22 +44,33 @@ def seed_everything(seed=11711):
 class ParaphraseGPT(nn.Module):
   """GPT-2 with a binary classification head for paraphrase detection."""
 
-  def __init__(self, args):
+  def __init__(self, args, pretrained=True):
     super().__init__()
-    self.gpt = GPT2Model.from_pretrained(model=args.model_size, d=args.d, l=args.l, num_heads=args.num_heads)
+    if pretrained:
+      self.gpt = GPT2Model.from_pretrained(model=args.model_size, d=args.d, l=args.l, num_heads=args.num_heads,
+                                           **gpt_config_kwargs(args))
+    else:
+      # Architecture only, for when every weight comes from our own checkpoint.
+      self.gpt = GPT2Model.from_size(d=args.d, l=args.l, num_heads=args.num_heads, **gpt_config_kwargs(args))
     # 2 classes: 0 = not paraphrase, 1 = paraphrase
     self.paraphrase_detection_head = nn.Linear(args.d, 2)
 
     for param in self.gpt.parameters():
       param.requires_grad = True
 
-  def forward(self, input_ids, attention_mask):
+  def forward(self, input_ids, attention_mask, cu_seqlens=None):
     """Grab the last token hidden state and classify it."""
-    gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask)
+    gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask, cu_seqlens=cu_seqlens,
+                           return_last_token_only=True)
     last_token = gpt_outputs['last_token']
     logits = self.paraphrase_detection_head(last_token)
     return logits
 
+  @classmethod
+  def from_checkpoint(cls, saved):
+    """The model saved by save_model (or quantization.py), without downloading or converting GPT-2 weights."""
+    return load_task_checkpoint(cls, saved)
+
 
 
 def save_model(model, optimizer, args, filepath):
@@ -84,17 +97,18 @@ def train(args):
   para_train_data = ParaphraseDetectionDataset(para_train_data, args)
   para_dev_data = ParaphraseDetectionDataset(para_dev_data, args)
 
-  para_train_dataloader = DataLoader(para_train_data, shuffle=True, batch_size=args.batch_size,
-                                     collate_fn=para_train_data.collate_fn)
-  para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                   collate_fn=para_dev_data.collate_fn)
+  para_train_dataloader = length_grouped_dataloader(para_train_data, args, shuffle=True)
+  para_dev_dataloader = length_grouped_dataloader(para_dev_data, args, shuffle=False)
 
   args = add_arguments(args)
   model = ParaphraseGPT(args)
   model = model.to(device)
+  if args.bf16_weights:
+    model = model.to(torch.bfloat16)
 
   lr = args.lr
-  optimizer = AdamW(model.parameters(), lr=lr, weight_decay=0.)
+  optimizer = AdamW(model.parameters(), lr=lr, weight_decay=0., master_weights=args.bf16_weights, foreach=True,
+                    flat=args.flat_optimizer, state_format=args.optimizer_state)
   best_dev_acc = 0
 
   # Run for the specified number of epochs.
@@ -108,12 +122,14 @@ def train(args):
       b_ids = b_ids.to(device)
       b_mask = b_mask.to(device)
       labels = labels.to(device)
+      b_cu_seqlens = batch_cu_seqlens(batch, device)
 
       # Compute the loss, gradients, and update the model's parameters.
       optimizer.zero_grad()
-      logits = model(b_ids, b_mask)
+      with autocast_context(device, args.precision):
+        logits = model(b_ids, b_mask, cu_seqlens=b_cu_seqlens)
       preds = torch.argmax(logits, dim=1)
-      loss = F.cross_entropy(logits, labels, reduction='mean')
+      loss = F.cross_entropy(logits.float(), labels, reduction='mean')
       loss.backward()
       optimizer.step()
 
@@ -122,23 +138,27 @@ def train(args):
 
     train_loss = train_loss / num_batches
 
-    dev_acc, dev_f1, *_ = model_eval_paraphrase(para_dev_dataloader, model, device)
+    dev_acc, dev_f1, *_ = model_eval_paraphrase(para_dev_dataloader, model, device, args.precision)
 
     if dev_acc > best_dev_acc:
       best_dev_acc = dev_acc
       save_model(model, optimizer, args, args.filepath)
 
-    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, dev acc :: {dev_acc :.3f}")
+    # Packed batches hold no padding; the sampler's ratio is for the padded layout.
+    padding_ratio = 0. if args.packed else para_train_dataloader.batch_sampler.padding_ratio
+    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, dev acc :: {dev_acc :.3f}, padding :: {padding_ratio :.1%}")
 
 
 @torch.no_grad()
 def test(args):
   """Eval on dev + test and write csvs for the autograder."""
   device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-  saved = torch.load(args.filepath)
+  saved = torch.load(args.filepath, map_location='cpu', mmap=True, weights_only=False)
 
-  model = ParaphraseGPT(saved['args'])
-  model.load_state_dict(saved['model'])
+  model = ParaphraseGPT.from_checkpoint(saved)
+  if 'quantization' in saved:
+    # The int8 modules of a quantization.py artifact only run on CPU.
+    device = torch.device('cpu')
   model = model.to(device)
   model.eval()
   print(f"Loaded model to test from {args.filepath}")
@@ -149,14 +169,13 @@ def test(args):
   para_dev_data = ParaphraseDetectionDataset(para_dev_data, args)
   para_test_data = ParaphraseDetectionTestDataset(para_test_data, args)
 
-  para_dev_dataloader = DataLoader(para_dev_data, shuffle=False, batch_size=args.batch_size,
-                                   collate_fn=para_dev_data.collate_fn)
-  para_test_dataloader = DataLoader(para_test_data, shuffle=False, batch_size=args.batch_size,
-                                    collate_fn=para_test_data.collate_fn)
+  para_dev_dataloader = length_grouped_dataloader(para_dev_data, args, shuffle=False)
+  para_test_dataloader = length_grouped_dataloader(para_test_data, args, shuffle=False)
 
-  dev_para_acc, _, dev_para_y_pred, _, dev_para_sent_ids = model_eval_paraphrase(para_dev_dataloader, model, device)
+  dev_para_acc, _, dev_para_y_pred, _, dev_para_sent_ids = model_eval_paraphrase(para_dev_dataloader, model, device,
+                                                                                   args.precision)
   print(f"dev paraphrase acc :: {dev_para_acc :.3f}")
-  test_para_y_pred, test_para_sent_ids = model_test_paraphrase(para_test_dataloader, model, device)
+  test_para_y_pred, test_para_sent_ids = model_test_paraphrase(para_test_dataloader, model, device, args.precision)
 
   # autograder wants token ids: no=3919, yes=8505
   TOKEN_NO = 3919
@@ -193,6 +212,14 @@ def get_args():
   parser.add_argument("--model_size", type=str,
                       help="gpt2 model variant (up to xl is fine)",
                       choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'], default='gpt2')
+  parser.add_argument("--attention_backend", type=str, help="attention implementation",
+                      choices=['reference', 'sdpa', 'chunked'], default='reference')
+  parser.add_argument("--gradient_checkpointing", type=parse_gradient_checkpointing, default='none',
+                      help="recompute layer activations in backward to save memory: none, all, every-<k> or budget-<MB>")
+  parser.add_argument("--packed", action='store_true',
+                      help="padding-free batches: concatenate each batch into one token stream instead of padding it")
+
+  add_efficiency_arguments(parser)
 
   args = parser.parse_args()
   return args
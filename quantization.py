@@ -0,0 +1,198 @@
+'''
+Post-training quantization of the GPT-2 task models.
+
+int8 (paraphrase, sst, cfimdb): dynamic quantization for CPU inference. The attention, MLP and output
+(hidden_state_to_token) projections are stored as int8 with per-tensor scales; activations are quantized
+on the fly. The artifact keeps the original 'args' / 'model_config', so the test() functions of
+paraphrase_detection.py and classifier.py load it like any other checkpoint.
+
+int4 (sonnet): weight-only group-wise 4-bit storage of the GPT2Layer linear layers (modules/int4_linear.py),
+with the remaining weights in bf16, for holding gpt2-large / gpt2-xl on small inference nodes. The artifact
+has its own format and is loaded with load_int4_sonnet (sonnet_generation.py --int4_checkpoint).
+
+Running:
+  `python quantization.py --task paraphrase --filepath 10-1e-05-paraphrase.pt --out paraphrase-int8.pt`
+  `python quantization.py --task sst --filepath sst-classifier.pt --out sst-int8.pt --skip 'gpt.gpt_layers.0.*'`
+  `python quantization.py --task sonnet --scheme int4 --filepath 9_10-1e-05-sonnet.pt --out sonnet-int4.pt`
+'''
+
+import argparse
+import copy
+import fnmatch
+
+import torch
+
+from torch import nn
+
+from models.gpt2 import GPT2Model
+from modules.gpt2_layer import GPT2Layer
+from modules.int4_linear import Int4Linear
+from samplers import length_grouped_dataloader
+from utils import load_on_meta
+
+INT4_FORMAT = 'int4-groupwise'
+
+
+def _matches(name, patterns):
+  return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def quantize_int8(model, skip=(), inplace=False):
+  """
+  Returns an int8 version of model (a copy unless inplace) in which every nn.Linear is dynamically
+  quantized, except those whose qualified name (e.g. 'gpt.gpt_layers.3.interm_dense') matches one of the
+  fnmatch patterns in skip. GPT-2's output projection is tied to the word embedding, so it gets a
+  quantized copy in gpt.lm_head (skip 'gpt.lm_head' to keep the tied fp32 projection).
+  """
+  if not inplace:
+    model = copy.deepcopy(model)
+  model = model.cpu().eval()
+  for name, module in model.named_modules():
+    head_name = f'{name}.lm_head' if name else 'lm_head'
+    if isinstance(module, GPT2Model) and not _matches(head_name, skip):
+      module.lm_head = nn.Linear(module.config.hidden_size, module.config.vocab_size, bias=False)
+      module.lm_head.weight.data = module.word_embedding.weight.data.clone()
+
+  quantized_names = {name for name, module in model.named_modules()
+                     if isinstance(module, nn.Linear) and not _matches(name, skip)}
+  return torch.ao.quantization.quantize_dynamic(model, quantized_names, dtype=torch.qint8, inplace=True)
+
+
+def quantize_int4(model, group_size=64, skip=(), empty=False):
+  """
+  In place: replaces every nn.Linear inside a GPT2Layer (unless its qualified name matches a pattern in
+  skip) with an Int4Linear, and stores all remaining weights in bf16, so the model runs in bf16 without
+  autocast. With empty=True the Int4Linear buffers are only allocated (on the linear's device, e.g. meta),
+  to build a skeleton that an int4 state dict is then loaded into.
+  """
+  layer_names = [name for name, module in model.named_modules() if isinstance(module, GPT2Layer)]
+  for layer_name in layer_names:
+    layer = model.get_submodule(layer_name)
+    for name, linear in list(layer.named_modules()):
+      if not isinstance(linear, nn.Linear) or _matches(f'{layer_name}.{name}', skip):
+        continue
+      if empty:
+        int4_linear = Int4Linear(linear.in_features, linear.out_features, bias=linear.bias is not None,
+                                 group_size=group_size, device=linear.weight.device)
+      else:
+        int4_linear = Int4Linear.from_linear(linear, group_size=group_size)
+      parent_name, _, attr = name.rpartition('.')
+      setattr(layer.get_submodule(parent_name), attr, int4_linear)
+
+  for module in model.modules():
+    if not isinstance(module, Int4Linear):
+      for param in module.parameters(recurse=False):
+        param.data = param.data.to(torch.bfloat16)
+  return model
+
+
+def save_int4(model, args, filepath, group_size=64, skip=()):
+  save_info = {
+    'format': INT4_FORMAT,
+    'group_size': group_size,
+    'skip': list(skip),
+    'args': args,
+    'model': model.state_dict(),
+  }
+  torch.save(save_info, filepath)
+  print(f"save the int4 model to {filepath}")
+
+
+def load_int4_sonnet(filepath):
+  """Loads a SonnetGPT saved by save_int4 without ever materialising its fp32 weights."""
+  from sonnet_generation import SonnetGPT
+  saved = torch.load(filepath, map_location='cpu', mmap=True, weights_only=False)
+  if saved.get('format') != INT4_FORMAT:
+    raise ValueError(f'{filepath} is not an {INT4_FORMAT} checkpoint.')
+  def build():
+    return quantize_int4(SonnetGPT(saved['args'], pretrained=False), saved['group_size'], saved['skip'], empty=True)
+  return load_on_meta(build, saved['model']).eval()
+
+
+def state_dict_bytes(model):
+  return sum(t.numel() * t.element_size() for t in model.state_dict().values())
+
+
+def load_task_model(task, saved):
+  """Builds the task model a checkpoint belongs to (int8-quantized if the checkpoint is)."""
+  if task == 'paraphrase':
+    from paraphrase_detection import ParaphraseGPT
+    return ParaphraseGPT.from_checkpoint(saved)
+  elif task == 'sonnet':
+    from sonnet_generation import SonnetGPT
+    return SonnetGPT.from_checkpoint(saved)
+  else:
+    from classifier import GPT2SentimentClassifier
+    return GPT2SentimentClassifier.from_checkpoint(saved)
+
+
+def dev_accuracy(task, model, args):
+  device = torch.device('cpu')
+  if task == 'paraphrase':
+    from datasets import ParaphraseDetectionDataset, load_paraphrase_data
+    from evaluation import model_eval_paraphrase
+    dev_data = ParaphraseDetectionDataset(load_paraphrase_data(args.dev), args)
+    dev_dataloader = length_grouped_dataloader(dev_data, args, shuffle=False)
+    return model_eval_paraphrase(dev_dataloader, model, device)[0]
+
+  from classifier import SentimentDataset, load_data, model_eval
+  dev_data = SentimentDataset(load_data(args.dev, 'valid'), args)
+  dev_dataloader = length_grouped_dataloader(dev_data, args, shuffle=False)
+  return model_eval(dev_dataloader, model, device)[0]
+
+
+@torch.no_grad()
+def main(args):
+  saved = torch.load(args.filepath, map_location='cpu', weights_only=False)
+  if 'quantization' in saved:
+    raise ValueError(f'{args.filepath} is already quantized.')
+  model = load_task_model(args.task, saved).eval()
+
+  if args.scheme == 'int4':
+    fp32_bytes = state_dict_bytes(model)
+    model = quantize_int4(model, args.group_size, args.skip)
+    int4_bytes = state_dict_bytes(model)
+    print(f"weights :: fp32 {fp32_bytes / 2 ** 20 :.0f}MB, int4 {int4_bytes / 2 ** 20 :.0f}MB, "
+          f"{fp32_bytes / int4_bytes :.1f}x smaller")
+    save_int4(model, saved['args'], args.out, args.group_size, args.skip)
+    return
+
+  quantized_model = quantize_int8(model, args.skip)
+
+  fp32_acc = dev_accuracy(args.task, model, args)
+  int8_acc = dev_accuracy(args.task, quantized_model, args)
+  print(f"dev acc :: fp32 {fp32_acc :.3f}, int8 {int8_acc :.3f}, delta {int8_acc - fp32_acc :+.3f}")
+
+  save_info = {key: value for key, value in saved.items() if key != 'optim'}
+  save_info['model'] = quantized_model.state_dict()
+  save_info['quantization'] = {'scheme': 'dynamic-int8', 'skip': list(args.skip),
+                               'fp32_dev_acc': fp32_acc, 'int8_dev_acc': int8_acc}
+  torch.save(save_info, args.out)
+  print(f"save the quantized model to {args.out}")
+
+
+def get_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--task", type=str, choices=['paraphrase', 'sst', 'cfimdb', 'sonnet'], required=True)
+  parser.add_argument("--scheme", type=str, choices=['int8', 'int4'], default='int8',
+                      help="int8: dynamic quantization of the classifiers; int4: weight-only storage for sonnet generation")
+  parser.add_argument("--group_size", type=int, default=64, help="int4 only: inputs sharing a scale and minimum")
+  parser.add_argument("--filepath", type=str, help="trained fp32 checkpoint", required=True)
+  parser.add_argument("--out", type=str, help="where to write the int8 checkpoint", required=True)
+  parser.add_argument("--dev", type=str, help="dev set for the accuracy report (defaults to the task's dev set)")
+  parser.add_argument("--skip", type=str, nargs='*', default=[],
+                      help="fnmatch patterns of nn.Linear names to leave unquantized, e.g. 'gpt.gpt_layers.0.*' '*.out_dense'")
+  parser.add_argument("--batch_size", type=int, default=8)
+
+  args = parser.parse_args()
+  if (args.scheme == 'int4') != (args.task == 'sonnet'):
+    parser.error('int4 applies to the sonnet model, int8 to the classification tasks')
+  if args.dev is None:
+    args.dev = {'paraphrase': 'data/quora-dev.csv',
+                'sst': 'data/ids-sst-dev.csv',
+                'cfimdb': 'data/ids-cfimdb-dev.csv'}.get(args.task)
+  return args
+
+
+if __name__ == "__main__":
+  main(get_args())
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+import torch
+
+from torch import nn
+
+from classifier_test import CONFIG, TinySentimentClassifier, tiny_classifier
+from quantization import quantize_int8
+
+
+@torch.no_grad()
+def test_int8_round_trip():
+  model = tiny_classifier()
+  skip = ['gpt.gpt_layers.0.*', 'classifier']
+  quantized = quantize_int8(model, skip)
+  input_ids = torch.randint(0, model.gpt.config.vocab_size, (3, 10))
+  attention_mask = torch.ones_like(input_ids)
+  attention_mask[0, 7:] = 0
+
+  # Skipped linears stay fp32 and every other one (including the copy of the tied output projection) is int8.
+  linears = {name: module for name, module in model.named_modules() if isinstance(module, nn.Linear)}
+  assert any(name.startswith('gpt.gpt_layers.0.') for name in linears)
+  for name, module in quantized.named_modules():
+    if name in linears or name == 'gpt.lm_head':
+      skipped = name == 'classifier' or name.startswith('gpt.gpt_layers.0.')
+      assert (type(module) is nn.Linear) == skipped, name
+      assert isinstance(module, torch.ao.nn.quantized.dynamic.Linear) != skipped, name
+  assert isinstance(quantized.gpt.lm_head, torch.ao.nn.quantized.dynamic.Linear)
+  # The original model is left as it was.
+  assert all(type(module) is nn.Linear for module in linears.values())
+
+  # The artifact quantization.py writes loads back through from_checkpoint with the same outputs.
+  expected = quantized(input_ids, attention_mask)
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    filepath = os.path.join(tmp_dir, 'int8.pt')
+    torch.save({'model': quantized.state_dict(), 'model_config': CONFIG,
+                'quantization': {'scheme': 'dynamic-int8', 'skip': skip}}, filepath)
+    saved = torch.load(filepath, map_location='cpu', weights_only=False)
+  loaded = TinySentimentClassifier.from_checkpoint(saved).eval()
+  assert type(loaded.classifier) is nn.Linear
+  assert torch.equal(loaded(input_ids, attention_mask), expected)
+
+
+if __name__ == '__main__':
+  test_int8_round_trip()
+  print("Quantization tests passed!")
@@ -0,0 +1,121 @@
+'''
+Batch samplers that group examples of similar length, so a batch is padded to a length close to each of its
+examples rather than to the longest example in the dataset.
+'''
+
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader, Sampler
+
+
+class BucketBatchSampler(Sampler):
+  """
+  Yields batches of dataset indices, drawn from examples of similar length.
+
+  Every epoch the indices are shuffled and split into buckets of batch_size * bucket_size_multiplier examples. Each
+  bucket is sorted by length and cut into batches, and the batches of all buckets are shuffled again, so batch
+  composition and order both change across epochs. The shuffle is seeded from torch's global RNG like
+  DataLoader(shuffle=True), which makes it reproducible under seed_everything.
+
+  padding_ratio is the share of padding in the most recent epoch: padded positions over all positions, if every
+  batch is padded to its longest example.
+  """
+
+  def __init__(self, lengths, batch_size, shuffle=True, bucket_size_multiplier=50, drop_last=False):
+    self.lengths = np.asarray(lengths)
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    # Without shuffling (evaluation) the whole dataset is one bucket, so the batches are sorted by length.
+    self.bucket_size = batch_size * bucket_size_multiplier if shuffle else max(len(self.lengths), 1)
+    self.drop_last = drop_last
+    self.padding_ratio = 0.
+
+  def split(self, bucket):
+    """Cuts a bucket of indices, sorted by length, into batches."""
+    return [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+
+  def batches(self):
+    if self.shuffle:
+      generator = torch.Generator()
+      generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+      indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+    else:
+      indices = np.arange(len(self.lengths))
+
+    batches = []
+    for start in range(0, len(indices), self.bucket_size):
+      bucket = indices[start:start + self.bucket_size]
+      bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+      batches.extend(self.split(bucket))
+    if self.drop_last:
+      batches = [batch for batch in batches if len(batch) == self.batch_size]
+    if self.shuffle:
+      batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+    num_tokens = sum(self.lengths[batch].sum() for batch in batches)
+    num_positions = sum(self.lengths[batch].max() * len(batch) for batch in batches)
+    self.padding_ratio = 1 - num_tokens / max(num_positions, 1)
+    return [batch.tolist() for batch in batches]
+
+  def __iter__(self):
+    return iter(self.batches())
+
+  def __len__(self):
+    full_buckets, rest = divmod(len(self.lengths), self.bucket_size)
+    if self.drop_last:
+      return full_buckets * (self.bucket_size // self.batch_size) + rest // self.batch_size
+    return full_buckets * -(-self.bucket_size // self.batch_size) + -(-rest // self.batch_size)
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+  """
+  Yields batches of as many examples as fit in max_tokens once padded: rows * longest example <= max_tokens (an
+  example longer than max_tokens is a batch of its own). Short examples then share large batches while long ones
+  get small batches, so memory stays flat across datasets without hand-tuning a batch size.
+
+  Batches are formed within length-sorted buckets of bucket_size examples as in BucketBatchSampler, or over the
+  whole dataset sorted by length when not shuffling (evaluation). The batch size varies, so losses must be
+  normalised per example rather than by a fixed batch size.
+  """
+
+  def __init__(self, lengths, max_tokens, shuffle=True, bucket_size=4096):
+    super().__init__(lengths, batch_size=1, shuffle=shuffle)
+    self.max_tokens = max_tokens
+    self.bucket_size = bucket_size if shuffle else max(len(self.lengths), 1)
+    self._next_batches = None
+
+  def split(self, bucket):
+    batches, start = [], 0
+    for end, length in enumerate(self.lengths[bucket]):
+      # bucket is sorted, so the example at end is the longest of bucket[start:end + 1].
+      if end > start and (end + 1 - start) * length > self.max_tokens:
+        batches.append(bucket[start:end])
+        start = end
+    batches.append(bucket[start:])
+    return batches
+
+  def __iter__(self):
+    # __len__ may already have drawn this epoch's batches (DataLoader and tqdm ask for it before iterating).
+    batches, self._next_batches = self._next_batches or self.batches(), None
+    return iter(batches)
+
+  def __len__(self):
+    if self._next_batches is None:
+      self._next_batches = self.batches()
+    return len(self._next_batches)
+
+
+def length_grouped_dataloader(dataset, args, shuffle, lengths=None):
+  """
+  A DataLoader over a dataset with a TokenCache, or with the example lengths given. Batches fit a budget of
+  args.max_tokens padded tokens if it is set, and otherwise hold args.batch_size examples; either way they are
+  grouped by length, and sorted by length when not shuffling. Batches carry their sent_ids, so predictions stay
+  aligned with their examples.
+  """
+  lengths = dataset.token_cache.lengths() if lengths is None else lengths
+  if getattr(args, 'max_tokens', None):
+    batch_sampler = TokenBudgetBatchSampler(lengths, args.max_tokens, shuffle=shuffle)
+  else:
+    batch_sampler = BucketBatchSampler(lengths, args.batch_size, shuffle=shuffle)
+  return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn)
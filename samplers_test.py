@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+from samplers import BucketBatchSampler, TokenBudgetBatchSampler
+
+SEED = 0
+
+
+def test_bucket_batch_sampler():
+  lengths = np.random.default_rng(SEED).integers(5, 500, size=1003)
+  sampler = BucketBatchSampler(lengths, batch_size=8, bucket_size_multiplier=16)
+  torch.manual_seed(SEED)
+  batches = list(sampler)
+  assert len(batches) == len(sampler)
+  assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+  # Reproducible under a fixed seed, and reshuffled on the next epoch.
+  torch.manual_seed(SEED)
+  assert list(sampler) == batches
+  assert list(sampler) != batches
+
+  # Far less padding than random batches.
+  random_batches = torch.randperm(len(lengths)).split(8)
+  random_ratio = 1 - lengths.sum() / sum(lengths[batch.numpy()].max() * len(batch) for batch in random_batches)
+  assert sampler.padding_ratio < random_ratio / 4
+
+  sampler = BucketBatchSampler(lengths, batch_size=8, bucket_size_multiplier=16, drop_last=True)
+  batches = list(sampler)
+  assert len(batches) == len(sampler) and all(len(batch) == 8 for batch in batches)
+
+
+def test_token_budget_batch_sampler():
+  lengths = np.random.default_rng(SEED).integers(5, 500, size=1003)
+  lengths[0] = 3000  # longer than the budget: a batch of its own
+  for shuffle in (True, False):
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=2048, shuffle=shuffle, bucket_size=256)
+    num_batches = len(sampler)
+    batches = list(sampler)
+    assert len(batches) == num_batches
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(len(batch) * lengths[batch].max() <= 2048 for batch in batches if batch != [0])
+    assert [0] in batches
+
+
+def test_eval_batches_sorted():
+  lengths = np.random.default_rng(SEED).integers(5, 500, size=1003)
+  for sampler in (BucketBatchSampler(lengths, batch_size=8, shuffle=False),
+                  TokenBudgetBatchSampler(lengths, max_tokens=2048, shuffle=False)):
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    indices = [i for batch in batches for i in batch]
+    assert sorted(indices) == list(range(len(lengths)))
+    assert np.all(np.diff(lengths[indices]) >= 0)
+    # Deterministic: the same batches every time.
+    assert list(sampler) == batches
+
+
+if __name__ == '__main__':
+  test_bucket_batch_sampler()
+  test_token_budget_batch_sampler()
+  test_eval_batches_sorted()
+  print("Sampler tests passed!")
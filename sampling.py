@@ -0,0 +1,68 @@
+'''
+Temperature + nucleus (top-p) sampling over the vocabulary.
+
+The nucleus of a row is the smallest prefix of its tokens, by decreasing probability, whose mass reaches
+top_p: a token is kept if the tokens ranked above it hold at most top_p (the most likely one is always kept).
+Sorting all 50257 probabilities every step is the expensive part, so the candidates come from a
+torch.topk of top_k tokens instead. That is exact whenever the top_k tokens hold more than top_p, because
+the nucleus then ends inside them. Only rows where they do not (very flat distributions) get a full sort.
+
+temperature and top_p are floats or per-row [batch_size] tensors, and a torch.Generator makes sampling
+reproducible independently of the global RNG.
+'''
+
+import torch
+import torch.nn.functional as F
+
+
+def _per_row(value, logits):
+  """A float or [batch_size] tensor as something that broadcasts against [batch_size, vocab_size]."""
+  value = torch.as_tensor(value, dtype=torch.float32, device=logits.device)
+  return value[:, None] if value.dim() == 1 else value
+
+
+def top_p_candidates(logits, temperature=1.0, top_p=0.9, top_k=64):
+  """
+  logits: [batch_size, vocab_size]
+
+  Returns probs and token_ids, both [batch_size, num_candidates]: every row's candidate tokens by decreasing
+  probability, with the probabilities renormalised over the nucleus and zero outside it. num_candidates is
+  top_k, or vocab_size if some row needed the full sort.
+  """
+  probs = torch.softmax(logits.float() / _per_row(temperature, logits), dim=-1)
+  top_p = _per_row(top_p, logits)
+  vocab_size = probs.size(-1)
+
+  candidate_probs, candidate_ids = probs.topk(min(top_k, vocab_size), dim=-1)
+  fallback = candidate_probs.sum(dim=-1, keepdim=True) <= top_p
+  if fallback.any():
+    # Some nucleus may extend past the top k: sort those rows in full, padding the others with zero-probability
+    # candidates, which the nucleus never reaches since their top k already hold more than top_p.
+    fallback = fallback.squeeze(-1)
+    sorted_probs, sorted_ids = probs[fallback].sort(dim=-1, descending=True)
+    num_padding = vocab_size - candidate_probs.size(-1)
+    candidate_probs = F.pad(candidate_probs, (0, num_padding))
+    candidate_ids = F.pad(candidate_ids, (0, num_padding))
+    candidate_probs[fallback] = sorted_probs
+    candidate_ids[fallback] = sorted_ids
+
+  # Mass of the tokens ranked above each candidate.
+  mass_above = F.pad(candidate_probs.cumsum(dim=-1)[:, :-1], (1, 0))
+  candidate_probs = candidate_probs * (mass_above <= top_p)
+  candidate_probs = candidate_probs / candidate_probs.sum(dim=-1, keepdim=True)
+  return candidate_probs, candidate_ids
+
+
+def top_p_probs(logits, temperature=1.0, top_p=0.9, top_k=64):
+  """The sampling distribution of every row of [batch_size, vocab_size] logits, in vocabulary order."""
+  candidate_probs, candidate_ids = top_p_candidates(logits, temperature, top_p, top_k)
+  # Padded candidates repeat token 0 at probability zero (see top_p_candidates), so accumulate instead of
+  # overwriting: a plain scatter_ could replace token 0's real probability with one of those zeros.
+  return torch.zeros_like(logits, dtype=torch.float32).scatter_add_(-1, candidate_ids, candidate_probs)
+
+
+def sample(logits, temperature=1.0, top_p=0.9, top_k=64, generator=None):
+  """Samples one token per row of [batch_size, vocab_size] logits: [batch_size] token ids."""
+  candidate_probs, candidate_ids = top_p_candidates(logits, temperature, top_p, top_k)
+  index = torch.multinomial(candidate_probs, 1, generator=generator)
+  return candidate_ids.gather(-1, index).squeeze(-1)
@@ -0,0 +1,106 @@
+import time
+
+import torch
+
+from sampling import sample, top_p_probs
+
+SEED = 0
+VOCAB_SIZE = 50257
+
+
+def reference_top_p_probs(logits, temperature, top_p):
+  """The full-sort nucleus filter sampling.py replaces (as previously inlined in SonnetGPT.generate)."""
+  probs = torch.softmax(logits / temperature, dim=-1)
+  sorted_probs, sorted_indices = torch.sort(probs, descending=True)
+  cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+  top_p_mask = cumulative_probs <= top_p
+  top_p_mask[..., 1:] = top_p_mask[..., :-1].clone()
+  top_p_mask[..., 0] = True
+  filtered_probs = sorted_probs * top_p_mask
+  filtered_probs /= filtered_probs.sum(dim=-1, keepdim=True)
+  return torch.zeros_like(probs).scatter_(-1, sorted_indices, filtered_probs)
+
+
+def lm_like_logits(batch_size, scale=1.0):
+  """Logits peaked on a few dozen tokens, roughly like a language model's next-token distribution."""
+  logits = torch.randn(batch_size, VOCAB_SIZE) * scale
+  if scale >= 1.0:
+    for row in logits:
+      row[torch.randperm(VOCAB_SIZE)[:32]] += torch.linspace(8, 20, 32)
+  return logits
+
+
+def test_matches_full_sort():
+  torch.manual_seed(SEED)
+  # Peaked rows stay within the top k; the flat row (scale 0.1) needs the full-sort fallback.
+  logits = torch.cat([lm_like_logits(3), lm_like_logits(1, scale=0.1)])
+  for temperature in (0.7, 1.2):
+    for top_p in (0.5, 0.9, 1.0):
+      expected = reference_top_p_probs(logits, temperature, top_p)
+      actual = top_p_probs(logits, temperature, top_p, top_k=64)
+      assert torch.allclose(expected, actual, atol=1e-6), (temperature, top_p)
+
+
+def test_fallback_rows_keep_token_zero():
+  torch.manual_seed(SEED)
+  # Row 0 puts most of its nucleus on token 0; the flat row 1 needs the full sort, so row 0's candidates are padded.
+  logits = torch.cat([lm_like_logits(1), lm_like_logits(1, scale=0.1)])
+  logits[0, 0] = logits[0].max() + 2
+  expected = reference_top_p_probs(logits, 1.2, 0.9)
+  actual = top_p_probs(logits, 1.2, 0.9, top_k=64)
+  assert expected[0, 0] > 0
+  assert torch.allclose(expected, actual, atol=1e-6)
+
+
+def test_per_row_temperature():
+  torch.manual_seed(SEED)
+  logits = lm_like_logits(2)
+  temperature, top_p = torch.tensor([0.7, 1.2]), torch.tensor([0.9, 0.5])
+  actual = top_p_probs(logits, temperature, top_p)
+  for i in range(2):
+    expected = reference_top_p_probs(logits[i:i + 1], temperature[i].item(), top_p[i].item())
+    assert torch.allclose(expected, actual[i:i + 1], atol=1e-6)
+
+
+def test_sample_distribution():
+  torch.manual_seed(SEED)
+  logits = torch.randn(1, 20)
+  probs = reference_top_p_probs(logits, 0.8, 0.9)[0]
+  generator = torch.Generator().manual_seed(SEED)
+  samples = sample(logits.expand(100000, -1), 0.8, 0.9, top_k=8, generator=generator)
+  frequencies = torch.bincount(samples, minlength=20).float() / samples.numel()
+  assert torch.all(frequencies[probs == 0] == 0)
+  assert torch.allclose(frequencies, probs, atol=1e-2)
+
+  # A seeded generator reproduces the same tokens.
+  first = sample(logits.expand(16, -1), generator=torch.Generator().manual_seed(SEED))
+  second = sample(logits.expand(16, -1), generator=torch.Generator().manual_seed(SEED))
+  assert torch.equal(first, second)
+
+
+def benchmark(batch_size=16, steps=50, temperature=1.2, top_p=0.9):
+  """Per-step latency of the full sort vs. the top-k prefilter on vocabulary-sized logits."""
+  torch.manual_seed(SEED)
+  logits = lm_like_logits(batch_size)
+
+  def time_per_step(fn):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(steps):
+      fn()
+    return (time.perf_counter() - start) / steps * 1000
+
+  reference_ms = time_per_step(lambda: torch.multinomial(reference_top_p_probs(logits, temperature, top_p), 1))
+  prefilter_ms = time_per_step(lambda: sample(logits, temperature, top_p))
+  print(f"batch {batch_size} :: full sort {reference_ms :.2f}ms/step, top-k prefilter {prefilter_ms :.2f}ms/step, "
+        f"{reference_ms / prefilter_ms :.1f}x faster")
+
+
+if __name__ == '__main__':
+  test_matches_full_sort()
+  test_fallback_rows_keep_token_zero()
+  test_per_row_temperature()
+  test_sample_distribution()
+  print("Sampling tests passed!")
+  benchmark(batch_size=1)
+  benchmark(batch_size=16)
@@ -9,23 +9,29 @@ trains your SonnetGPT model and writes the required submission files.
 
 import argparse
 import random
+import time
 import torch
 
 import numpy as np
 import torch.nn.functional as F
 
 from torch import nn
-from torch.utils.data import DataLoader
 from tqdm import tqdm
+from torch.utils.checkpoint import checkpoint
 from transformers import GPT2Tokenizer
-from einops import rearrange
 
 from datasets import (
+  PackedSonnetsDataset,
   SonnetsDataset,
 )
 from models.gpt2 import GPT2Model
 
 from optimizer import AdamW
+from quantization import load_int4_sonnet
+from sampling import sample, top_p_probs
+from samplers import length_grouped_dataloader
+from utils import (add_efficiency_arguments, autocast_context, batch_cu_seqlens, gpt_config_kwargs,
+                   load_task_checkpoint, parse_gradient_checkpointing)
 
 TQDM_DISABLE = False
 
@@ -44,9 +50,14 @@ def seed_everything(seed=11711):
 class SonnetGPT(nn.Module):
   """GPT-2 fine-tuned to generate sonnets. basically a language model."""
 
-  def __init__(self, args):
+  def __init__(self, args, pretrained=True):
     super().__init__()
-    self.gpt = GPT2Model.from_pretrained(model=args.model_size, d=args.d, l=args.l, num_heads=args.num_heads)
+    if pretrained:
+      self.gpt = GPT2Model.from_pretrained(model=args.model_size, d=args.d, l=args.l, num_heads=args.num_heads,
+                                           **gpt_config_kwargs(args))
+    else:
+      # Architecture only, for when every weight comes from our own checkpoint.
+      self.gpt = GPT2Model.from_size(d=args.d, l=args.l, num_heads=args.num_heads, **gpt_config_kwargs(args))
     self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
     self.tokenizer.pad_token = self.tokenizer.eos_token
 
@@ -61,50 +72,355 @@ class SonnetGPT(nn.Module):
     return self.gpt.hidden_state_to_token(hidden_states)
 
 
+  def lm_loss(self, input_ids, attention_mask, chunk_size=256, cu_seqlens=None):
+    """
+    Mean next-token cross-entropy over the real tokens, without ever materialising the [b, t, vocab] logits.
+
+    Only positions whose next token is real are scored (so the last position and padding are skipped).
+    Their hidden states are projected to the vocabulary chunk_size positions at a time, and when training
+    each chunk is checkpointed: backward recomputes that chunk's logits instead of keeping them all alive.
+    With cu_seqlens, input_ids is a packed stream (see PackedSonnetsDataset) and the last position of every
+    sequence in it is skipped instead.
+    """
+    hidden_states = self.gpt(input_ids=input_ids, attention_mask=attention_mask,
+                             cu_seqlens=cu_seqlens)['last_hidden_state']
+    if cu_seqlens is None:
+      target_mask = attention_mask[:, 1:].bool()
+      hidden_states = hidden_states[:, :-1][target_mask]  # [num_targets, hidden_size]
+      labels = input_ids[:, 1:][target_mask]
+    else:
+      target_mask = torch.ones_like(input_ids, dtype=torch.bool)
+      target_mask[cu_seqlens[1:] - 1] = False
+      hidden_states = hidden_states[target_mask]
+      labels = input_ids.roll(-1)[target_mask]
+
+    needs_grad = torch.is_grad_enabled() and hidden_states.requires_grad
+    loss = 0.
+    for start in range(0, labels.size(0), chunk_size):
+      chunk = (hidden_states[start:start + chunk_size], labels[start:start + chunk_size])
+      if needs_grad:
+        loss = loss + checkpoint(self._chunk_loss, *chunk, use_reentrant=False)
+      else:
+        loss = loss + self._chunk_loss(*chunk)
+    return loss / labels.size(0)
+
+  def _chunk_loss(self, hidden_states, labels):
+    logits = self.gpt.hidden_state_to_token(hidden_states).float()
+    return F.cross_entropy(logits, labels, reduction='sum')
+
+  @classmethod
+  def from_checkpoint(cls, saved):
+    """The model saved by save_model, without downloading or converting GPT-2 weights."""
+    return load_task_checkpoint(cls, saved)
+
   def get_device(self):
     for param in self.gpt.parameters():
       return param.device
 
   @torch.no_grad()
   def generate(self, encoding, temperature=0.7, top_p=0.9, max_length=128):
-    """top-p sampling with temperature. could try beam search or top-k too."""
-    token_ids = encoding.to(self.get_device())
-    attention_mask = torch.ones(token_ids.shape, dtype=torch.int64).to(self.get_device())
-
-
-    for _ in range(max_length):
-      # Forward pass to get logits
-      logits_sequence = self.forward(token_ids, attention_mask)
-      logits_last_token = logits_sequence[:, -1, :] / temperature  # Apply temperature scaling
-
-      # Convert logits to probabilities
-      probs = torch.nn.functional.softmax(logits_last_token, dim=-1)
-
-      # Top-p (nucleus) sampling
-      sorted_probs, sorted_indices = torch.sort(probs, descending=True)
-      cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
-      top_p_mask = cumulative_probs <= top_p
-      top_p_mask[..., 1:] = top_p_mask[..., :-1].clone()  # Shift mask right for proper thresholding
-      top_p_mask[..., 0] = True  # Always include the highest probability token
-      filtered_probs = sorted_probs * top_p_mask  # Zero out unlikely tokens
-      filtered_probs /= filtered_probs.sum(dim=-1, keepdim=True)  # Normalize probabilities
-
-      # Sample from filtered distribution
-      sampled_index = torch.multinomial(filtered_probs, 1)
-      sampled_token = sorted_indices.gather(dim=-1, index=sampled_index)
-
-      # Stop if end-of-sequence token is reached
-      if sampled_token.item() == self.tokenizer.eos_token_id:
+    """top-p sampling with temperature for a single prompt [1, prompt_len], see generate_batch."""
+    device = self.get_device()
+    generated = self.generate_batch([encoding[0].tolist()], temperature, top_p, max_length)[0]
+    token_ids = torch.cat([encoding.to(device), torch.tensor([generated], dtype=torch.long, device=device)], dim=1)
+    generated_output = self.tokenizer.decode(token_ids[0].cpu().numpy().tolist())[3:]
+    return token_ids, generated_output
+
+  def left_pad(self, prompts):
+    """Batches prompts (lists of token ids) with end-of-sequence padding on the left: token_ids, attention_mask."""
+    prompt_length = max(len(prompt) for prompt in prompts)
+    token_ids = torch.full((len(prompts), prompt_length), self.tokenizer.eos_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompts), prompt_length), dtype=torch.long)
+    for i, prompt in enumerate(prompts):
+      token_ids[i, prompt_length - len(prompt):] = torch.tensor(prompt, dtype=torch.long)
+      attention_mask[i, prompt_length - len(prompt):] = 1
+    return token_ids.to(self.get_device()), attention_mask.to(self.get_device())
+
+  @torch.no_grad()
+  def generate_batch(self, prompts, temperature=0.7, top_p=0.9, max_length=128, compact_every=8, generator=None,
+                     stopping_criteria=None):
+    """
+    top-p sampling with temperature for several prompts (lists of token ids) at once. Returns the sampled
+    continuation of each prompt, up to max_length tokens and without the end-of-sequence token.
+
+    The prompts are left-padded, so every row's last token sits in the final column and each step appends
+    one column; position ids count real tokens only. With config.use_cache, the prompts are encoded once and
+    every later step only feeds the newly sampled tokens. Finished rows keep sampling (into a discarded
+    buffer) until the next compaction every compact_every steps, which is the only host sync: it drops them
+    from the batch and the cache, and stops once every row is done. Sampling uses sampling.sample, with
+    generator (a torch.Generator) for reproducible outputs. A row also ends once stopping_criteria (e.g. a
+    LineCountStopping) says it is complete.
+    """
+    device = self.get_device()
+    eos_token_id = self.tokenizer.eos_token_id
+    use_cache = self.gpt.config.use_cache
+    num_prompts = len(prompts)
+    token_ids, attention_mask = self.left_pad(prompts)
+
+    rows = torch.arange(num_prompts, device=device)  # prompt index of each row still in the batch
+    done = torch.zeros(num_prompts, dtype=torch.bool, device=device)
+    generated = torch.full((num_prompts, max_length), eos_token_id, dtype=torch.long, device=device)
+    past_key_values = None
+    input_ids = token_ids
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+    for step in range(max_length):
+      # Forward pass to get the hidden state of the last position, the only one projected to the vocabulary.
+      gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                             use_cache=use_cache, return_last_token_only=True, position_ids=position_ids)
+      logits_last_token = self.gpt.hidden_state_to_token(gpt_outputs['last_token']).float()
+      sampled_token = sample(logits_last_token, temperature, top_p, generator=generator)  # [rows]
+
+      # Rows that already ended keep emitting end-of-sequence.
+      done = done | (sampled_token == eos_token_id)
+      sampled_token = sampled_token.masked_fill(done, eos_token_id)
+      generated[rows, step] = sampled_token
+
+      token_ids = torch.cat([token_ids, sampled_token[:, None]], dim=1)
+      attention_mask = torch.cat([attention_mask, torch.ones_like(sampled_token)[:, None]], dim=1)
+      if stopping_criteria is not None:
+        done = done | stopping_criteria(token_ids)
+      if use_cache:
+        past_key_values = gpt_outputs['past_key_values']
+        input_ids = sampled_token[:, None]
+        position_ids = position_ids[:, -1:] + 1
+      else:
+        input_ids = token_ids
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+      if (step + 1) % compact_every == 0:
+        keep = (~done).nonzero().squeeze(1)
+        if keep.numel() == 0:
+          break
+        if keep.numel() < rows.numel():
+          rows, done, token_ids, attention_mask, input_ids, position_ids = (
+            t.index_select(0, keep) for t in (rows, done, token_ids, attention_mask, input_ids, position_ids))
+          if past_key_values is not None:
+            past_key_values = select_cache(past_key_values, keep)
+
+    outputs = []
+    for tokens in generated.tolist():
+      outputs.append(tokens[:tokens.index(eos_token_id)] if eos_token_id in tokens else tokens)
+    return outputs
+
+  @torch.no_grad()
+  def generate_beam(self, prompts, num_beams=4, max_length=128, length_penalty=1.0, stopping_criteria=None):
+    """
+    Beam search for several prompts (lists of token ids) at once; returns the best continuation of each,
+    without the end-of-sequence token.
+
+    Every prompt keeps num_beams live hypotheses, all in one left-padded batch. A hypothesis ends with the
+    end-of-sequence token or once stopping_criteria says it is complete. Hypotheses are ranked by their summed
+    log-probability divided by (generated length) ** length_penalty, so values above 0 favour longer outputs.
+    A prompt is done once it has num_beams ended hypotheses and no live one can still rank above them.
+    """
+    device = self.get_device()
+    eos_token_id = self.tokenizer.eos_token_id
+    use_cache = self.gpt.config.use_cache
+    num_prompts = len(prompts)
+    token_ids, attention_mask = self.left_pad(prompts)
+    prompt_length = token_ids.size(1)
+
+    # num_beams rows per prompt. Only the first beam starts live, so the first step does not pick the same
+    # token num_beams times.
+    token_ids = token_ids.repeat_interleave(num_beams, dim=0)
+    attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+    beam_scores = torch.full((num_prompts, num_beams), float('-inf'), device=device)
+    beam_scores[:, 0] = 0
+    first_rows = torch.arange(num_prompts, device=device)[:, None] * num_beams  # of each prompt's beams
+    finished = [[] for _ in range(num_prompts)]  # (normalised score, tokens) of ended hypotheses
+    done = [False] * num_prompts
+    past_key_values = None
+    input_ids = token_ids
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+    def normalised(score, length):
+      return score / length ** length_penalty
+
+    for step in range(max_length):
+      gpt_outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values,
+                             use_cache=use_cache, return_last_token_only=True, position_ids=position_ids)
+      log_probs = F.log_softmax(self.gpt.hidden_state_to_token(gpt_outputs['last_token']).float(), dim=-1)
+      vocab_size = log_probs.size(-1)
+
+      # 2 * num_beams candidates per prompt leave num_beams live ones even if up to num_beams of them end here.
+      scores = (beam_scores.view(-1, 1) + log_probs).view(num_prompts, -1)
+      candidate_scores, candidate_indices = scores.topk(2 * num_beams, dim=1)
+      candidate_rows = first_rows + candidate_indices // vocab_size
+      candidate_tokens = candidate_indices % vocab_size
+      candidate_ends = candidate_tokens == eos_token_id
+      if stopping_criteria is not None:
+        candidate_ends |= stopping_criteria(token_ids[candidate_rows.view(-1)],
+                                            candidate_tokens.view(-1, 1)).view(num_prompts, -1)
+
+      next_rows, next_tokens, next_scores = [], [], []
+      candidates = zip(*(t.tolist() for t in (candidate_scores, candidate_rows, candidate_tokens, candidate_ends)))
+      for i, prompt_candidates in enumerate(candidates):
+        live = []
+        if not done[i]:
+          for rank, (score, row, token, ends) in enumerate(prompt_candidates):
+            if len(live) == num_beams:
+              break
+            if not ends:
+              live.append((row, token, score))
+            elif rank < num_beams:
+              tokens = token_ids[row, prompt_length:].tolist() + ([token] if token != eos_token_id else [])
+              finished[i].append((normalised(score, step + 1), tokens))
+          if len(finished[i]) >= num_beams:
+            finished[i] = sorted(finished[i], key=lambda hypothesis: hypothesis[0], reverse=True)[:num_beams]
+          done[i] = not live or (len(finished[i]) == num_beams
+                                 and normalised(live[0][2], step + 1) <= finished[i][-1][0])
+        if done[i]:
+          live = []
+        # Done prompts, and ones short of live candidates, fill their rows with hypotheses that can never win.
+        live += [(i * num_beams, eos_token_id, float('-inf'))] * (num_beams - len(live))
+        for row, token, score in live:
+          next_rows.append(row)
+          next_tokens.append(token)
+          next_scores.append(score)
+      if all(done):
         break
 
-      # Append sampled token
-      token_ids = torch.cat([token_ids, sampled_token], dim=1)
-      attention_mask = torch.cat(
-        [attention_mask, torch.ones((1, 1), dtype=torch.int64).to(self.get_device())], dim=1
-      )
+      rows = torch.tensor(next_rows, device=device)
+      new_tokens = torch.tensor(next_tokens, device=device)
+      beam_scores = torch.tensor(next_scores, device=device).view(num_prompts, num_beams)
+      token_ids = torch.cat([token_ids[rows], new_tokens[:, None]], dim=1)
+      attention_mask = torch.cat([attention_mask[rows], torch.ones_like(new_tokens)[:, None]], dim=1)
+      if use_cache:
+        past_key_values = select_cache(gpt_outputs['past_key_values'], rows)
+        input_ids = new_tokens[:, None]
+        position_ids = position_ids[rows, -1:] + 1
+      else:
+        input_ids = token_ids
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+    # Out of length: the live hypotheses of unfinished prompts compete as they are.
+    for i in range(num_prompts):
+      if not done[i]:
+        for j, score in enumerate(beam_scores[i].tolist()):
+          if score > float('-inf'):
+            tokens = token_ids[i * num_beams + j, prompt_length:].tolist()
+            finished[i].append((normalised(score, len(tokens)), tokens))
+    return [max(hypotheses, key=lambda hypothesis: hypothesis[0])[1] for hypotheses in finished]
+
+  @torch.no_grad()
+  def generate_speculative(self, encoding, draft, num_draft_tokens=4, temperature=0.7, top_p=0.9, max_length=128):
+    """
+    Speculative sampling for a single prompt [1, prompt_len]. The small draft GPT2Model proposes
+    num_draft_tokens tokens one at a time, and this model scores all of them in a single forward pass.
+    A draft token x is kept with probability min(1, p(x) / q(x)), where p and q are the target and draft
+    sampling distributions (both after temperature and top-p). The first rejected token is replaced by a
+    sample from max(0, p - q), renormalised; if every draft is kept, a bonus token is sampled from p.
+    The output is therefore distributed exactly as with generate, but costs fewer forward passes of this model.
+
+    Returns token_ids and the decoded text like generate, plus stats: the draft tokens 'proposed' and
+    'accepted', and the number of 'target_forwards'.
+    """
+    device = self.get_device()
+    eos_token_id = self.tokenizer.eos_token_id
+    token_ids = encoding.to(device)
+    prompt_length = token_ids.size(1)
+    target_past = draft_past = None
+    stats = {'proposed': 0, 'accepted': 0, 'target_forwards': 0}
+
+    while token_ids.size(1) - prompt_length < max_length:
+      length = token_ids.size(1)
+
+      # The draft proposes its tokens autoregressively, keeping the distribution q of every step.
+      input_ids = token_ids[:, cache_length(draft_past):]
+      draft_tokens, draft_probs = [], []
+      for _ in range(num_draft_tokens):
+        attention_mask = torch.ones((1, cache_length(draft_past) + input_ids.size(1)), dtype=torch.long, device=device)
+        outputs = draft(input_ids=input_ids, attention_mask=attention_mask, past_key_values=draft_past,
+                        use_cache=True, return_last_token_only=True)
+        draft_past = outputs['past_key_values']
+        probs = top_p_probs(draft.hidden_state_to_token(outputs['last_token']).float(), temperature, top_p)
+        input_ids = torch.multinomial(probs, 1)
+        draft_tokens.append(input_ids[0])
+        draft_probs.append(probs[0])
+      draft_tokens = torch.cat(draft_tokens)  # [k]
+      draft_probs = torch.stack(draft_probs)  # [k, vocab_size]
+
+      # One target pass over the uncached tokens and every draft; its last k + 1 positions give p.
+      input_ids = torch.cat([token_ids[:, cache_length(target_past):], draft_tokens[None]], dim=1)
+      attention_mask = torch.ones((1, cache_length(target_past) + input_ids.size(1)), dtype=torch.long, device=device)
+      outputs = self.gpt(input_ids=input_ids, attention_mask=attention_mask, past_key_values=target_past,
+                         use_cache=True)
+      target_past = outputs['past_key_values']
+      hidden_states = outputs['last_hidden_state'][0, -(num_draft_tokens + 1):]
+      target_probs = top_p_probs(self.gpt.hidden_state_to_token(hidden_states).float(), temperature, top_p)
+      stats['target_forwards'] += 1
+
+      # Keep the longest prefix of drafts that pass the ratio test.
+      index = torch.arange(num_draft_tokens, device=device)
+      ratios = target_probs[index, draft_tokens] / draft_probs[index, draft_tokens]
+      accepted = torch.rand(num_draft_tokens, device=device) < ratios
+      num_accepted = int(accepted.cumprod(dim=0).sum())
+      if num_accepted < num_draft_tokens:
+        next_probs = (target_probs[num_accepted] - draft_probs[num_accepted]).clamp(min=0)
+        if next_probs.sum() <= 0:  # p == q on the nucleus: nothing to correct
+          next_probs = target_probs[num_accepted]
+      else:
+        next_probs = target_probs[num_draft_tokens]
+      new_tokens = torch.cat([draft_tokens[:num_accepted], torch.multinomial(next_probs, 1)])
+      stats['proposed'] += num_draft_tokens
+      stats['accepted'] += num_accepted
+
+      # Both caches may only keep the positions that stay in the sequence.
+      target_past = crop_cache(target_past, length + num_accepted)
+      draft_past = crop_cache(draft_past, length + num_accepted)
+      token_ids = torch.cat([token_ids, new_tokens[None]], dim=1)
+
+      # Stop at end-of-sequence, which is not part of the output.
+      eos_positions = (new_tokens == eos_token_id).nonzero()
+      if eos_positions.numel() > 0:
+        token_ids = token_ids[:, :length + int(eos_positions[0])]
+        break
 
+    token_ids = token_ids[:, :prompt_length + max_length]
     generated_output = self.tokenizer.decode(token_ids[0].cpu().numpy().tolist())[3:]
-    return token_ids, generated_output
+    return token_ids, generated_output, stats
+
+
+def cache_length(past_key_values):
+  return past_key_values[0][0].size(-2) if past_key_values is not None else 0
+
+
+class LineCountStopping:
+  """
+  Stopping criterion for SonnetGPT.generate_batch / generate_beam: a sequence is complete once the prompt plus
+  its continuation hold num_lines newlines, i.e. all 14 lines of a sonnet are written. GPT-2 rarely emits the
+  end-of-sequence token on its own, so without this every sonnet runs to max_length.
+  """
+
+  def __init__(self, tokenizer, num_lines=14):
+    self.num_lines = num_lines
+    # Newlines per vocabulary entry (e.g. 'Ċ' has one, 'ĊĊ' two).
+    self.newline_counts = torch.tensor([tokenizer.decode([token_id]).count('\n')
+                                        for token_id in range(len(tokenizer))])
+
+  def __call__(self, token_ids, next_tokens=None):
+    """
+    token_ids: [batch_size, seq_len] prompts plus continuations (padding must not decode to newlines)
+    next_tokens: optional [batch_size, num_candidates] tokens that would be appended to each row
+
+    Returns whether each row is complete ([batch_size]), or each row extended by each candidate.
+    """
+    newline_counts = self.newline_counts.to(token_ids.device)
+    num_lines = newline_counts[token_ids].sum(dim=1)
+    if next_tokens is not None:
+      num_lines = num_lines[:, None] + newline_counts[next_tokens]
+    return num_lines >= self.num_lines
+
+
+def select_cache(past_key_values, rows):
+  """Keeps (or reorders) the batch rows of the cached keys/values."""
+  return tuple((key.index_select(0, rows), value.index_select(0, rows)) for key, value in past_key_values)
+
+
+def crop_cache(past_key_values, length):
+  """Drops the cached keys/values of every position from length on."""
+  return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
 
 
 def save_model(model, optimizer, args, filepath):
@@ -125,9 +441,13 @@ def train(args):
   """Train GPT-2 as a language model on sonnets."""
   device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
   # Create the data and its corresponding datasets and dataloader.
-  sonnet_dataset = SonnetsDataset(args.sonnet_path)
-  sonnet_dataloader = DataLoader(sonnet_dataset, shuffle=True, batch_size=args.batch_size,
-                                 collate_fn=sonnet_dataset.collate_fn)
+  if args.packed:
+    sonnet_dataset = PackedSonnetsDataset(args.sonnet_path, args.block_size,
+                                          reset_attention=args.packed_attention == 'document')
+    sonnet_dataloader = length_grouped_dataloader(sonnet_dataset, args, shuffle=True, lengths=sonnet_dataset.lengths())
+  else:
+    sonnet_dataset = SonnetsDataset(args.sonnet_path)
+    sonnet_dataloader = length_grouped_dataloader(sonnet_dataset, args, shuffle=True)
 
   # Create the held-out dataset: these only have the first 3 lines. Your job is to fill in the rest!
   held_out_sonnet_dataset = SonnetsDataset(args.held_out_sonnet_path)
@@ -135,9 +455,12 @@ def train(args):
   args = add_arguments(args)
   model = SonnetGPT(args)
   model = model.to(device)
+  if args.bf16_weights:
+    model = model.to(torch.bfloat16)
 
   lr = args.lr
-  optimizer = AdamW(model.parameters(), lr=lr)
+  optimizer = AdamW(model.parameters(), lr=lr, master_weights=args.bf16_weights, foreach=True,
+                    flat=args.flat_optimizer, state_format=args.optimizer_state)
 
   # Run for the specified number of epochs.
   for epoch in range(args.epochs):
@@ -150,13 +473,13 @@ def train(args):
       b_ids, b_mask = batch['token_ids'], batch['attention_mask']
       b_ids = b_ids.to(device)
       b_mask = b_mask.to(device)
+      b_cu_seqlens = batch_cu_seqlens(batch, device)
 
       # Compute the loss, gradients, and update the model's parameters.
       optimizer.zero_grad()
-      logits = model(b_ids, b_mask)
-      logits = rearrange(logits[:, :-1].contiguous(), 'b t d -> (b t) d')  # Ignore the last prediction in the sequence.
-      labels = b_ids[:, 1:].contiguous().flatten()  # Ignore the first token to compose the labels.
-      loss = F.cross_entropy(logits, labels, reduction='mean')
+      with autocast_context(device, args.precision):
+        # Next-token loss over the real tokens, streamed over chunks of positions.
+        loss = model.lm_loss(b_ids, b_mask, chunk_size=args.lm_loss_chunk_size, cu_seqlens=b_cu_seqlens)
       loss.backward()
       optimizer.step()
 
@@ -164,37 +487,107 @@ def train(args):
       num_batches += 1
 
     train_loss = train_loss / num_batches
-    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}.")
+    # Packed blocks hold no padding; the sampler's ratio is for the padded layout.
+    padding_ratio = 0. if args.packed else sonnet_dataloader.batch_sampler.padding_ratio
+    print(f"Epoch {epoch}: train loss :: {train_loss :.3f}, padding :: {padding_ratio :.1%}.")
     print('Generating several output sonnets...')
     model.eval()
     for batch in held_out_sonnet_dataset:
       encoding = model.tokenizer(batch[1], return_tensors='pt', padding=True, truncation=True).to(device)
-      output = model.generate(encoding['input_ids'], temperature=args.temperature, top_p=args.top_p)
+      with autocast_context(device, args.precision):
+        output = model.generate(encoding['input_ids'], temperature=args.temperature, top_p=args.top_p)
       print(f'{batch[1]}{output[1]}\n\n')
 
     # maybe add early stopping? sonnet dataset is pretty small
     save_model(model, optimizer, args, f'{epoch}_{args.filepath}')
 
 
+def load_draft_model(args, device):
+  """
+  The draft GPT2Model for --draft_checkpoint (a SonnetGPT fine-tuned at a smaller size) or --draft_model_size
+  (pretrained weights only), or None when speculative decoding is off.
+  """
+  if args.draft_checkpoint:
+    saved = torch.load(args.draft_checkpoint, map_location='cpu', mmap=True, weights_only=False)
+    draft = SonnetGPT.from_checkpoint(saved).gpt
+  elif args.draft_model_size:
+    draft_args = add_arguments(argparse.Namespace(model_size=args.draft_model_size))
+    draft = GPT2Model.from_pretrained(model=draft_args.model_size, d=draft_args.d, l=draft_args.l,
+                                      num_heads=draft_args.num_heads)
+  else:
+    return None
+  return draft.to(device).eval()
+
+
 @torch.no_grad()
 def generate_submission_sonnets(args):
   device = torch.device('cuda') if args.use_gpu else torch.device('cpu')
-  saved = torch.load(f'{args.epochs-1}_{args.filepath}', weights_only=False)
-
-  model = SonnetGPT(saved['args'])
-  model.load_state_dict(saved['model'])
+  if args.int4_checkpoint:
+    # 4-bit GPT2Layer weights from quantization.py, dequantized on the fly while generating.
+    model = load_int4_sonnet(args.int4_checkpoint)
+  else:
+    saved = torch.load(f'{args.epochs-1}_{args.filepath}', map_location='cpu', mmap=True, weights_only=False)
+    model = SonnetGPT.from_checkpoint(saved)
   model = model.to(device)
   model.eval()
 
   # Create the held-out dataset: these only have the first 3 lines. Your job is to fill in the rest!
   held_out_sonnet_dataset = SonnetsDataset(args.held_out_sonnet_path)
 
+  # Decode the held-out set: one prompt at a time speculatively when there is a draft model,
+  # otherwise in batches of prompts.
+  draft = load_draft_model(args, device)
+  prompts = [model.tokenizer(sonnet, truncation=True)['input_ids'] for _, sonnet in held_out_sonnet_dataset]
+  outputs = []
+  stats = {'proposed': 0, 'accepted': 0, 'target_forwards': 0}
+  start_time = time.time()
+  stopping_criteria = LineCountStopping(model.tokenizer, args.stop_at_lines) if args.stop_at_lines else None
+  if draft is not None:
+    for prompt in prompts:
+      with autocast_context(device, args.precision):
+        token_ids, _, prompt_stats = model.generate_speculative(
+          torch.tensor([prompt]), draft, args.num_draft_tokens, temperature=args.temperature, top_p=args.top_p,
+          max_length=args.max_length)
+      outputs.append(token_ids[0, len(prompt):].tolist())
+      for key in stats:
+        stats[key] += prompt_stats[key]
+  else:
+    for start in range(0, len(prompts), args.generation_batch_size):
+      batch_prompts = prompts[start:start + args.generation_batch_size]
+      with autocast_context(device, args.precision):
+        if args.decoding == 'beam':
+          outputs.extend(model.generate_beam(batch_prompts, num_beams=args.num_beams, max_length=args.max_length,
+                                             length_penalty=args.length_penalty, stopping_criteria=stopping_criteria))
+        else:
+          outputs.extend(model.generate_batch(batch_prompts, temperature=args.temperature, top_p=args.top_p,
+                                              max_length=args.max_length, stopping_criteria=stopping_criteria))
+  if device.type == 'cuda':
+    torch.cuda.synchronize()
+  elapsed = time.time() - start_time
+  num_generated = sum(len(output) for output in outputs)
+  print(f"generated {num_generated} tokens in {elapsed :.1f}s :: {num_generated / elapsed :.1f} tokens/s")
+  # Tokens not generated compared to always running to max_length.
+  num_saved = len(outputs) * args.max_length - num_generated
+  print(f"{num_saved / len(outputs) :.1f} of {args.max_length} tokens saved per sonnet")
+  if draft is not None:
+    # Every target forward replaces one step of plain decoding, so tokens per forward bounds the speedup.
+    print(f"speculative decoding :: acceptance rate {stats['accepted'] / stats['proposed'] :.3f}, "
+          f"{num_generated / stats['target_forwards'] :.2f} tokens per target forward")
+    # The measured speedup: plain sampling of the same prompts, one at a time with the same settings.
+    baseline_generated, baseline_start = 0, time.time()
+    for prompt in prompts:
+      with autocast_context(device, args.precision):
+        baseline_generated += len(model.generate_batch([prompt], temperature=args.temperature, top_p=args.top_p,
+                                                       max_length=args.max_length)[0])
+    if device.type == 'cuda':
+      torch.cuda.synchronize()
+    baseline_rate = baseline_generated / (time.time() - baseline_start)
+    print(f"plain decoding :: {baseline_rate :.1f} tokens/s, speculative decoding is "
+          f"{num_generated / elapsed / baseline_rate :.2f}x faster")
+
   generated_sonnets = []
-  for batch in held_out_sonnet_dataset:
-    sonnet_id = batch[0]
-    encoding = model.tokenizer(batch[1], return_tensors='pt', padding=False, truncation=True).to(device)
-    output = model.generate(encoding['input_ids'], temperature=args.temperature, top_p=args.top_p)[0][0]
-    decoded_output = model.tokenizer.decode(output)
+  for (sonnet_id, _), prompt, output in zip(held_out_sonnet_dataset, prompts, outputs):
+    decoded_output = model.tokenizer.decode(prompt + output)
     full_sonnet = f'{decoded_output}\n\n'
     generated_sonnets.append((sonnet_id, full_sonnet))
 
@@ -220,15 +613,49 @@ def get_args():
 
   # Generation parameters.
   parser.add_argument("--temperature", type=float, help="softmax temperature.", default=1.2)
+  parser.add_argument("--int4_checkpoint", type=str, default=None,
+                      help="generate the submission from a 4-bit checkpoint written by quantization.py --scheme int4")
   parser.add_argument("--top_p", type=float, help="Cumulative probability distribution for nucleus sampling.",
                       default=0.9)
+  parser.add_argument("--generation_batch_size", type=int, default=16,
+                      help="held-out prompts sampled together when generating the submission")
+  parser.add_argument("--decoding", type=str, choices=['sample', 'beam'], default='sample',
+                      help="submission decoding: top-p sampling or beam search")
+  parser.add_argument("--num_beams", type=int, default=4)
+  parser.add_argument("--length_penalty", type=float, default=1.0,
+                      help="beam scores are divided by length ** length_penalty; larger values favour longer sonnets")
+  parser.add_argument("--max_length", type=int, default=128, help="maximum tokens generated per sonnet")
+  parser.add_argument("--stop_at_lines", type=int, default=14,
+                      help="end a sonnet once it has this many lines (0 only stops at end-of-sequence)")
+  parser.add_argument("--draft_model_size", type=str, default=None,
+                      choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'],
+                      help="speculative decoding: pretrained GPT-2 that proposes tokens for the (larger) sonnet model")
+  parser.add_argument("--draft_checkpoint", type=str, default=None,
+                      help="speculative decoding: a smaller fine-tuned sonnet checkpoint to use as the draft model")
+  parser.add_argument("--num_draft_tokens", type=int, default=4,
+                      help="tokens the draft model proposes per verification pass")
 
   parser.add_argument("--batch_size", help='The training batch size.', type=int, default=8)
+  parser.add_argument("--packed", action='store_true',
+                      help="train on fixed-length blocks of EOS-separated sonnets instead of padded batches of sonnets")
+  parser.add_argument("--block_size", type=int, default=256, help="with --packed, tokens per block")
+  parser.add_argument("--packed_attention", type=str, choices=('document', 'block'), default='document',
+                      help="with --packed, whether tokens attend within their own sonnet or across the whole block")
+  parser.add_argument("--lm_loss_chunk_size", type=int, default=256,
+                      help="positions projected to the vocabulary at once when computing the LM loss")
   parser.add_argument("--lr", type=float, help="learning rate", default=1e-5)
   parser.add_argument("--model_size", type=str, help="The model size as specified on hugging face.",
                       choices=['gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'], default='gpt2')
+  parser.add_argument("--attention_backend", type=str, help="attention implementation",
+                      choices=['reference', 'sdpa', 'chunked'], default='reference')
+  parser.add_argument("--gradient_checkpointing", type=parse_gradient_checkpointing, default='none',
+                      help="recompute layer activations in backward to save memory: none, all, every-<k> or budget-<MB>")
+
+  add_efficiency_arguments(parser)
 
   args = parser.parse_args()
+  if (args.draft_model_size or args.draft_checkpoint) and args.decoding != 'sample':
+    parser.error('speculative decoding (--draft_model_size / --draft_checkpoint) only applies to --decoding sample')
   return args
 
 
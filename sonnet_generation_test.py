@@ -0,0 +1,205 @@
+import torch
+import torch.nn.functional as F
+
+from gpt2_test import SEED, tiny_model
+from sampling import top_p_probs
+from sonnet_generation import LineCountStopping, SonnetGPT, cache_length
+
+NEWLINE_ID = 10
+DOUBLE_NEWLINE_ID = 11
+EOS_ID = 99
+
+
+class TinyTokenizer:
+  """
+  The parts of GPT2Tokenizer that generation uses, over tiny_model's 100 tokens: 10 is a newline, 11 two newlines
+  (like GPT-2's 'ĊĊ') and 99 the EOS.
+  """
+  eos_token_id = EOS_ID
+
+  def __len__(self):
+    return 100
+
+  def decode(self, token_ids):
+    special = {NEWLINE_ID: '\n', DOUBLE_NEWLINE_ID: '\n\n'}
+    return ''.join(special.get(token_id, f'<{token_id}>') for token_id in token_ids)
+
+
+class TinySonnetGPT(SonnetGPT):
+  """SonnetGPT around tiny_model, so generation can be checked without downloading weights or a tokenizer."""
+
+  def __init__(self, **kwargs):
+    torch.nn.Module.__init__(self)
+    self.gpt = tiny_model(**kwargs)
+    self.tokenizer = TinyTokenizer()
+
+
+@torch.no_grad()
+def draft_model():
+  """tiny_model with perturbed weights: a draft whose distribution q differs from the target's p."""
+  draft = tiny_model()
+  for param in draft.parameters():
+    param.add_(torch.randn_like(param) * 0.1)
+  return draft
+
+
+def record_calls(calls, name, model):
+  """Appends (name, cached length, input_ids, outputs) to calls on every forward pass of model."""
+  def hook(module, args, kwargs, outputs):
+    calls.append((name, cache_length(kwargs['past_key_values']), kwargs['input_ids'].clone(), outputs))
+  return model.register_forward_hook(hook, with_kwargs=True)
+
+
+def reference_lm_loss(model, input_ids, attention_mask):
+  """Next-token cross-entropy over the full [b, t, vocab] logits, skipping targets that are padding."""
+  logits = model(input_ids, attention_mask)[:, :-1]
+  labels = input_ids[:, 1:].masked_fill(attention_mask[:, 1:] == 0, -100)
+  return F.cross_entropy(logits.flatten(0, 1), labels.flatten(), ignore_index=-100)
+
+
+def test_lm_loss():
+  model = TinySonnetGPT()
+  lengths = [7, 10, 3]
+  input_ids = torch.randint(0, 100, (3, 10))
+  attention_mask = (torch.arange(10)[None, :] < torch.tensor(lengths)[:, None]).long()  # right-padded
+  params = list(model.parameters())
+  expected = reference_lm_loss(model, input_ids, attention_mask)
+  expected_grads = torch.autograd.grad(expected, params)
+
+  # Chunks of 4 of the 17 targets; the packed layout holds the same three sequences without padding.
+  padded = model.lm_loss(input_ids, attention_mask, chunk_size=4)
+  packed_ids = input_ids[attention_mask.bool()]
+  packed = model.lm_loss(packed_ids, torch.ones_like(packed_ids), chunk_size=4, cu_seqlens=torch.tensor([0, 7, 17, 20]))
+  for loss in (padded, packed):
+    assert torch.allclose(loss, expected, atol=1e-5)
+    grads = torch.autograd.grad(loss, params)
+    assert all(torch.allclose(g, h, atol=1e-5) for g, h in zip(expected_grads, grads))
+
+
+@torch.no_grad()
+def greedy(model, prompt, max_length):
+  """Argmax decoding of one prompt (a list of token ids) without a cache, up to the EOS or max_length tokens."""
+  token_ids = torch.tensor([prompt])
+  generated = []
+  for _ in range(max_length):
+    next_token = int(model(token_ids, torch.ones_like(token_ids))[0, -1].argmax())
+    if next_token == EOS_ID:
+      break
+    generated.append(next_token)
+    token_ids = torch.cat([token_ids, torch.tensor([[next_token]])], dim=1)
+  return generated
+
+
+def stop_at(token):
+  """A stopping criterion that ends a hypothesis once token is appended."""
+  def stopping_criteria(token_ids, next_tokens=None):
+    return next_tokens == token if next_tokens is not None else token_ids[:, -1] == token
+  return stopping_criteria
+
+
+@torch.no_grad()
+def test_beam_search_greedy():
+  model = TinySonnetGPT()
+  prompts = [[5, 6, 7, 8], [9, 3], [1, 2, 3, 4, 5, 6]]  # left-padded to different lengths
+  expected = [greedy(model, prompt, 12) for prompt in prompts]
+  assert model.generate_beam(prompts, num_beams=1, max_length=12) == expected
+
+
+@torch.no_grad()
+def test_beam_search_keeps_finished():
+  model = TinySonnetGPT()
+  prompt = [5, 6, 7, 8]
+  first_token = greedy(model, prompt, 1)[0]
+  calls = []
+  hook = record_calls(calls, 'target', model.gpt)
+  # The best first step ends its hypothesis at once. Without a length penalty, scores only fall as hypotheses
+  # grow, so it stays the best while the other beams go on searching.
+  outputs = model.generate_beam([prompt], num_beams=2, max_length=12, length_penalty=0.,
+                                stopping_criteria=stop_at(first_token))
+  hook.remove()
+  assert outputs == [[first_token]]
+  assert len(calls) > 1
+
+
+def test_line_count_stopping():
+  stopping = LineCountStopping(TinyTokenizer())
+  prompt = [5, DOUBLE_NEWLINE_ID, 6]  # two newlines
+  continuation = []
+  for line in range(12):
+    continuation += [20 + line, 30 + line, NEWLINE_ID]
+  sequence = prompt + continuation
+
+  # Complete exactly once the 14th newline is written.
+  for length in range(len(prompt), len(sequence) + 1):
+    complete = stopping(torch.tensor([sequence[:length]]))
+    assert complete.tolist() == [length == len(sequence)]
+  # Candidates extend each row: a newline completes the sonnet, two newlines overshoot it, any other token doesn't.
+  complete = stopping(torch.tensor([sequence[:-1]]), torch.tensor([[NEWLINE_ID, 7, DOUBLE_NEWLINE_ID]]))
+  assert complete.tolist() == [[True, False, True]]
+
+
+@torch.no_grad()
+def test_speculative_self_draft():
+  model = TinySonnetGPT()
+  torch.manual_seed(SEED)
+  prompt = torch.randint(0, EOS_ID, (1, 5))
+  # The draft's q is the target's p, so every ratio test passes.
+  token_ids, _, stats = model.generate_speculative(prompt, model.gpt, num_draft_tokens=4, temperature=1.0,
+                                                   top_p=1.0, max_length=20)
+  assert stats['proposed'] > 0
+  assert stats['accepted'] == stats['proposed']
+  assert torch.equal(token_ids[:, :5], prompt)
+
+
+@torch.no_grad()
+def test_speculative_caches():
+  model = TinySonnetGPT()
+  draft = draft_model()
+  prompt = torch.randint(0, EOS_ID, (1, 5))
+  calls = []
+  hooks = [record_calls(calls, 'target', model.gpt), record_calls(calls, 'draft', draft)]
+  token_ids, _, stats = model.generate_speculative(prompt, draft, num_draft_tokens=4, temperature=0.2,
+                                                   top_p=1.0, max_length=24)
+  for hook in hooks:
+    hook.remove()
+  assert stats['accepted'] < stats['proposed']  # some drafts were rejected, so the caches were cropped
+
+  # Each round starts with a draft call after the previous round's target call. At that point both caches
+  # must hold exactly a prefix of the output: replaying the call without a cache gives the same states.
+  for i, (name, past_length, input_ids, outputs) in enumerate(calls):
+    if name == 'draft' and i > 0 and calls[i - 1][0] == 'draft':
+      continue  # mid-round, the draft's cache holds its own proposals
+    assert past_length < token_ids.size(1)
+    replay_ids = torch.cat([token_ids[:, :past_length], input_ids], dim=1)
+    replayed = model.gpt if name == 'target' else draft
+    expected = replayed(replay_ids, torch.ones_like(replay_ids))['last_hidden_state'][:, past_length:]
+    if name == 'target':
+      assert torch.allclose(outputs['last_hidden_state'], expected, atol=1e-5)
+    else:
+      assert torch.allclose(outputs['last_token'], expected[:, -1], atol=1e-5)
+
+
+@torch.no_grad()
+def test_speculative_top_p_support():
+  model = TinySonnetGPT()
+  draft = draft_model()
+  prompt = torch.randint(0, EOS_ID, (1, 5))
+  token_ids, _, _ = model.generate_speculative(prompt, draft, num_draft_tokens=4, temperature=0.5,
+                                               top_p=0.5, max_length=24)
+  assert token_ids.size(1) > 5
+
+  # Every generated token lies in the nucleus of the target's own distribution, whatever the draft proposed.
+  hidden_states = model.gpt(token_ids, torch.ones_like(token_ids))['last_hidden_state'][0, 4:-1]
+  probs = top_p_probs(model.gpt.hidden_state_to_token(hidden_states).float(), 0.5, 0.5)
+  assert torch.all(probs.gather(-1, token_ids[0, 5:, None]) > 0)
+
+
+if __name__ == '__main__':
+  test_lm_loss()
+  test_beam_search_greedy()
+  test_beam_search_keeps_finished()
+  test_line_count_stopping()
+  test_speculative_self_draft()
+  test_speculative_caches()
+  test_speculative_top_p_support()
+  print("Sonnet generation tests passed!")
@@ -27,6 +27,12 @@ default_cache_path = os.path.join(hf_cache_home, "transformers")
 PYTORCH_PRETRAINED_BERT_CACHE = os.getenv("PYTORCH_PRETRAINED_BERT_CACHE", default_cache_path)
 PYTORCH_TRANSFORMERS_CACHE = os.getenv("PYTORCH_TRANSFORMERS_CACHE", PYTORCH_PRETRAINED_BERT_CACHE)
 TRANSFORMERS_CACHE = os.getenv("TRANSFORMERS_CACHE", PYTORCH_TRANSFORMERS_CACHE)
+# GPT2Model.from_pretrained keeps HuggingFace's GPT-2 weights here once they are converted to our layout.
+CONVERTED_WEIGHTS_CACHE = os.getenv("CONVERTED_WEIGHTS_CACHE", os.path.join(hf_cache_home, "converted-gpt2"))
+# datasets.TokenCache keeps pre-tokenized datasets here, keyed by a hash of their content.
+TOKEN_CACHE = os.getenv("TOKEN_CACHE", os.path.join(hf_cache_home, "cs224n-tokens"))
+# classifier.cached_features keeps frozen GPT-2 embeddings here, keyed by the weights and the data.
+FEATURE_CACHE = os.getenv("FEATURE_CACHE", os.path.join(hf_cache_home, "cs224n-features"))
 
 PRESET_MIRROR_DICT = {
     "tuna": "https://mirrors.tuna.tsinghua.edu.cn/hugging-face-models",
@@ -48,6 +54,116 @@ def model_size_to_params(model_size):
   else:
     raise Exception(f'{model_size} is not supported.')
 
+def parse_gradient_checkpointing(spec):
+  """
+  Parses the --gradient_checkpointing flag into GPT2Config kwargs:
+    none: keep all activations; all: checkpoint every layer; every-<k>: checkpoint every k-th layer;
+    budget-<MB>: checkpoint as few layers as needed to fit the activations into MB megabytes.
+  """
+  if spec == 'none':
+    return {'gradient_checkpointing': False}
+  if spec == 'all':
+    return {'gradient_checkpointing': True, 'checkpoint_every': 1}
+  mode, _, value = spec.partition('-')
+  if mode == 'every' and value.isdigit() and int(value) > 0:
+    return {'gradient_checkpointing': True, 'checkpoint_every': int(value)}
+  if mode == 'budget':
+    return {'gradient_checkpointing': True, 'checkpoint_budget_mb': float(value)}
+  raise ValueError(f'Unknown gradient checkpointing mode {spec}.')
+
+
+def add_efficiency_arguments(parser):
+  """
+  Adds the batching, precision and optimizer flags the task scripts share to parser. Its parse_args then also
+  rejects combinations of them that do not work together.
+  """
+  parser.add_argument("--max_tokens", type=int, default=None,
+                      help="batch by a budget of padded tokens (rows x longest example) instead of --batch_size")
+  parser.add_argument("--fused_qkv", action='store_true',
+                      help="compute the query, key and value projections as one matmul")
+  parser.add_argument("--precision", type=str, help="bf16 autocasts the training and eval loops to bfloat16",
+                      choices=('fp32', 'bf16'), default='fp32')
+  parser.add_argument("--bf16_weights", action='store_true',
+                      help="with --precision bf16, also store the weights in bf16 and keep fp32 master weights in AdamW")
+  parser.add_argument("--flat_optimizer", action='store_true',
+                      help="keep parameters, gradients and AdamW moments in single contiguous buffers")
+  parser.add_argument("--optimizer_state", type=str, choices=('fp32', 'int8', 'factored'), default='fp32',
+                      help="int8 stores the AdamW moments blockwise-quantized to 8 bits, about 4x smaller; factored "
+                           "keeps only row and column second-moment statistics for matrices (Adafactor-style)")
+
+  # parse_args goes through parse_known_args, so checking there covers both.
+  parse_known_args = parser.parse_known_args
+
+  def parse_and_check(*args, **kwargs):
+    namespace, extras = parse_known_args(*args, **kwargs)
+    if namespace.bf16_weights and namespace.precision != 'bf16':
+      parser.error('--bf16_weights requires --precision bf16')
+    if namespace.flat_optimizer and namespace.optimizer_state != 'fp32':
+      parser.error('--flat_optimizer keeps the optimizer state in fp32')
+    return namespace, extras
+
+  parser.parse_known_args = parse_and_check
+
+
+def gpt_config_kwargs(args):
+  """GPT2Config options picked on the command line. Older checkpoints' args may not carry them."""
+  return {
+    'attention_backend': getattr(args, 'attention_backend', 'reference'),
+    'fused_qkv': getattr(args, 'fused_qkv', False),
+    **getattr(args, 'gradient_checkpointing', {}),
+  }
+
+
+def autocast_context(device, precision):
+  """Autocast for --precision: bf16 runs matmuls in bfloat16 (norms and softmax stay fp32), fp32 is a no-op."""
+  return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+def load_on_meta(build, state_dict):
+  """
+  Calls build() on the meta device and assigns the tensors of state_dict as the module's weights, so no
+  throwaway initialisation is ever allocated. With a state dict from torch.load(..., mmap=True) the weights
+  are paged in from disk as they are used. Buffers left out of state dicts are recreated afterwards.
+  """
+  with torch.device('meta'):
+    module = build()
+  module.load_state_dict(state_dict, assign=True)
+  for submodule in module.modules():
+    if hasattr(submodule, 'init_non_persistent_buffers'):
+      submodule.init_non_persistent_buffers()
+  return module
+
+
+def load_task_checkpoint(cls, saved):
+  """
+  The task model (cls, e.g. SonnetGPT) saved in a checkpoint, without downloading or converting GPT-2 weights.
+  It is built from the checkpoint's 'model_config' (classifier.py) or 'args'. An int8 artifact written by
+  quantization.py is rebuilt from real weights, quantized, then overwritten; any other is loaded on meta.
+  """
+  config = saved['model_config'] if 'model_config' in saved else saved['args']
+  if 'quantization' in saved:
+    from quantization import quantize_int8
+    model = quantize_int8(cls(config, pretrained=False), saved['quantization']['skip'], inplace=True)
+    model.load_state_dict(saved['model'])
+    return model
+  return load_on_meta(lambda: cls(config, pretrained=False), saved['model'])
+
+
+def state_dict_hash(module):
+  """sha256 hex digest of a module's parameters and buffers: identifies the exact weights, e.g. to key a cache."""
+  digest = sha256()
+  for name, tensor in module.state_dict().items():
+    digest.update(f'{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode('utf-8'))
+    digest.update(tensor.detach().float().cpu().numpy().tobytes())
+  return digest.hexdigest()
+
+
+def batch_cu_seqlens(batch, device):
+  """The sequence offsets of a packed batch (see datasets.collate_token_ids) on device, None for a padded batch."""
+  cu_seqlens = batch.get('cu_seqlens')
+  return cu_seqlens.to(device) if cu_seqlens is not None else None
+
+
 def is_torch_available():
   return True
 
@@ -349,12 +465,3 @@ def get_parameter_dtype(parameter: Union[nn.Module]):
     first_tuple = next(gen)
     return first_tuple[1].dtype
 
-
-def get_extended_attention_mask(attention_mask: Tensor, dtype) -> Tensor:
-  # attention_mask [batch_size, seq_length]
-  assert attention_mask.dim() == 2
-  # [batch_size, 1, 1, seq_length] for multi-head attention
-  extended_attention_mask = attention_mask[:, None, None, :]
-  extended_attention_mask = extended_attention_mask.to(dtype=dtype)  # fp16 compatibility
-  extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
-  return extended_attention_mask